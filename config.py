@@ -12,6 +12,16 @@ TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH", "")
 SESSION_DIR = Path(os.getenv("SESSION_DIR", "./sessions"))
 SESSION_DIR.mkdir(exist_ok=True)
 
+# Channel photo cache (profile photos keyed by channel and photo id)
+PHOTO_CACHE_DIR = SESSION_DIR / "photo_cache"
+PHOTO_CACHE_DIR.mkdir(exist_ok=True)
+PHOTO_CACHE_TTL = int(os.getenv("PHOTO_CACHE_TTL", "86400"))  # Seconds
+
+# Telegram client registry limits
+TELEGRAM_MAX_CLIENTS = int(os.getenv("TELEGRAM_MAX_CLIENTS", "500"))
+TELEGRAM_CLIENT_TTL = int(os.getenv("TELEGRAM_CLIENT_TTL", "900"))  # Seconds idle before eviction
+TELEGRAM_DL_CONCURRENCY = int(os.getenv("TELEGRAM_DL_CONCURRENCY", "8"))  # In-flight downloads per client
+
 # Database Configuration
 # Check if /app/data exists (Railway Volume)
 if os.path.exists("/app/data"):
@@ -22,6 +32,11 @@ elif os.path.exists("data"):
 else:
     DB_PATH = "telegram_feed.db"
 
+# PostgreSQL connection pool (per process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds
+
 # Server Configuration
 HOST = os.getenv("HOST", "127.0.0.1")
 PORT = int(os.getenv("PORT", "8000"))
@@ -17,11 +17,20 @@ if DATABASE_URL:
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
     
+    # psycopg 3 (postgresql+psycopg://) can prepare statements server-side; with
+    # prepare_threshold=0 the hot single-row lookups are planned once per connection.
+    # psycopg2 has no server-side prepare, and SQLAlchemy's compiled cache covers the Python side.
+    connect_args = {"prepare_threshold": 0} if DATABASE_URL.startswith("postgresql+psycopg://") else {}
+    
     # Create PostgreSQL engine
     engine = create_engine(
         DATABASE_URL,
+        connect_args=connect_args,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
         pool_pre_ping=True,  # Verify connections before using them
-        pool_recycle=300,    # Recycle connections after 5 minutes
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_use_lifo=True,  # Reuse the warmest connection; idle extras age out
     )
     print(f"✓ Connected to PostgreSQL database")
 else:
@@ -34,7 +43,8 @@ else:
     )
     print(f"✓ Using local SQLite database: {SQLALCHEMY_DATABASE_URL}")
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: values read after commit (logs, returned objects) don't trigger a reload
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
 def get_db():
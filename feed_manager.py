@@ -1,5 +1,5 @@
 import uuid
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from sqlalchemy.orm import Session
 from database import SessionLocal
 from sql_models import Feed
@@ -99,11 +99,33 @@ class FeedConfigManager:
             )
             db.add(db_feed)
             db.commit()
-            db.refresh(db_feed)
             return self._to_pydantic(db_feed)
         finally:
             db.close()
     
+    def _apply_updates(self, feed: Feed, updates: Dict):
+        """Apply a dict of field updates to a SQL feed row."""
+        for key, value in updates.items():
+            if hasattr(feed, key):
+                # Handle special JSON fields
+                if key == 'filters':
+                     # If value is dict, use it. If Pydantic, dump it. If None, set to None.
+                     if value is None:
+                         setattr(feed, key, None)
+                     else:
+                         setattr(feed, key, value.model_dump() if hasattr(value, 'model_dump') else value)
+                elif key == 'source_filters':
+                     if value is None:
+                         setattr(feed, key, None)
+                     else:
+                         # Convert keys to strings for JSON storage if needed
+                         val_to_store = {}
+                         for k, v in value.items():
+                             val_to_store[str(k)] = v.model_dump() if hasattr(v, 'model_dump') else v
+                         setattr(feed, key, val_to_store)
+                else:
+                    setattr(feed, key, value)
+
     def update_feed(self, user_id: str, feed_id: str, updates: Dict) -> Optional[FeedConfig]:
         """Update a feed."""
         db = self.get_db()
@@ -112,34 +134,55 @@ class FeedConfigManager:
             if not feed:
                 return None
             
-            for key, value in updates.items():
-                if hasattr(feed, key):
-                    # Handle special JSON fields
-                    # Handle special JSON fields
-                    if key == 'filters':
-                         # If value is dict, use it. If Pydantic, dump it. If None, set to None.
-                         if value is None:
-                             setattr(feed, key, None)
-                         else:
-                             setattr(feed, key, value.model_dump() if hasattr(value, 'model_dump') else value)
-                    elif key == 'source_filters':
-                         if value is None:
-                             setattr(feed, key, None)
-                         else:
-                             # Convert keys to strings for JSON storage if needed
-                             val_to_store = {}
-                             for k, v in value.items():
-                                 val_to_store[str(k)] = v.model_dump() if hasattr(v, 'model_dump') else v
-                             setattr(feed, key, val_to_store)
-                    else:
-                        setattr(feed, key, value)
+            self._apply_updates(feed, updates)
             
             db.commit()
-            db.refresh(feed)
             return self._to_pydantic(feed)
         finally:
             db.close()
     
+    def update_feeds_bulk(self, user_id: str, updates: List[Tuple[str, Dict]]):
+        """
+        Apply several feed updates in one transaction. Feeds sharing the same
+        plain-column patch are written with a single UPDATE ... WHERE id IN (...).
+        """
+        if not updates:
+            return
+        
+        # Later entries for the same feed win, as if applied in order
+        merged: Dict[str, Dict] = {}
+        for feed_id, feed_updates in updates:
+            merged.setdefault(feed_id, {}).update(
+                (key, value) for key, value in feed_updates.items() if hasattr(Feed, key)
+            )
+        
+        groups: Dict[tuple, List[str]] = {}
+        orm_updates: Dict[str, Dict] = {}
+        for feed_id, patch in merged.items():
+            if not patch:
+                continue
+            key = tuple(sorted(patch.items()))
+            try:
+                groups.setdefault(key, []).append(feed_id)
+            except TypeError:
+                # Unhashable (JSON) values need the per-row conversion in _apply_updates
+                orm_updates[feed_id] = patch
+        
+        db = self.get_db()
+        try:
+            for patch, feed_ids in groups.items():
+                db.query(Feed).filter(Feed.user_id == user_id, Feed.id.in_(feed_ids)).update(
+                    dict(patch),
+                    synchronize_session=False
+                )
+            if orm_updates:
+                for feed in db.query(Feed).filter(Feed.user_id == user_id, Feed.id.in_(orm_updates)).all():
+                    self._apply_updates(feed, orm_updates[feed.id])
+            
+            db.commit()
+        finally:
+            db.close()
+    
     def delete_feed(self, user_id: str, feed_id: str) -> bool:
         """Delete a feed."""
         db = self.get_db()
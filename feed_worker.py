@@ -25,9 +25,10 @@ logger = logging.getLogger(__name__)
 class FeedWorker:
     """Background worker that listens to channels and queues messages for forwarding."""
     
-    def __init__(self, feed_config_manager: FeedConfigManager):
+    def __init__(self, feed_config_manager: FeedConfigManager, user_manager: Optional[UserManager] = None):
         self.feed_config_manager = feed_config_manager
-        self.user_manager = UserManager()
+        # Share the app's UserManager so its cache invalidations reach the worker
+        self.user_manager = user_manager or UserManager()
         self.active_handlers: Dict[str, Set] = {}  # user_id -> set of handler references
         self.user_config_hashes: Dict[str, str] = {} # user_id -> config hash
         self.running = False
@@ -81,6 +82,9 @@ class FeedWorker:
                 feeds_by_user[user_id] = []
             feeds_by_user[user_id].append(feed)
         
+        # Subscription status is part of the handler state; fetch it for all users at once
+        statuses = await self.user_manager.aget_subscription_statuses(list(feeds_by_user))
+        
         # Set up handlers for each user
         for user_id, feeds in feeds_by_user.items():
             # Compute config hash to detect changes
@@ -88,7 +92,7 @@ class FeedWorker:
             current_hash = str([f.model_dump() for f in sorted_feeds])
             
             # Also check subscription status as part of state
-            sub_status = self.user_manager.get_subscription_status(user_id)
+            sub_status = statuses[user_id]
             current_hash += f"_{sub_status.tier}_{sub_status.is_expired}"
             
             if user_id not in self.active_handlers or self.user_config_hashes.get(user_id) != current_hash:
@@ -481,12 +485,12 @@ class FeedWorker:
 # Global worker instance
 _worker: FeedWorker = None
 
-async def start_feed_worker():
+async def start_feed_worker(user_manager: Optional[UserManager] = None):
     """Start the global feed worker."""
     global _worker
     if _worker is None:
         feed_config_manager = FeedConfigManager()
-        _worker = FeedWorker(feed_config_manager)
+        _worker = FeedWorker(feed_config_manager, user_manager)
     
     await _worker.start()
 
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Cookie, Response, Request, Header, Body, Depends
+from fastapi import FastAPI, HTTPException, Cookie, Response, Request, Header, Body, Depends, BackgroundTasks
 from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional, Any
@@ -6,11 +6,12 @@ import uuid
 import models
 # Import ALL SQLAlchemy models so tables get created
 from sql_models import WebSession, User, Feed, UserSession, MessageLog
-from telegram_client import get_telegram_manager, cleanup_client
+from telegram_client import get_telegram_manager, cleanup_client, start_client_eviction, NotAuthenticatedError, TwoFactorRequiredError
 import asyncio
 from contextlib import asynccontextmanager
 import os
-from database import engine, Base, SessionLocal
+from database import engine, Base, SessionLocal, get_db
+from sqlalchemy.orm import Session
 import config
 
 # Import rate limiting
@@ -27,10 +28,10 @@ from stripe_payment import stripe_service
 from tbank_payment import tbank_service
 
 from coinbase_payment import coinbase_service
-import json
+import orjson
 import logging
 from datetime import datetime, timedelta
-from sqlalchemy import text
+from sqlalchemy import text, select, delete, func
 
 # Configure logging
 import sys
@@ -72,6 +73,36 @@ def setup_logging():
 setup_logging()
 logger = logging.getLogger(__name__)
 
+def dedupe_user_sessions():
+    """
+    Keep only the most recently used session per (user_phone, instance_id) so
+    the unique index backing the save_session upsert can be created.
+    """
+    with SessionLocal() as db:
+        duplicated = db.execute(
+            select(UserSession.user_phone, UserSession.instance_id)
+            .group_by(UserSession.user_phone, UserSession.instance_id)
+            .having(func.count() > 1)
+        ).all()
+        if not duplicated:
+            return
+        
+        stale_ids = []
+        for user_phone, instance_id in duplicated:
+            rows = db.execute(
+                select(UserSession.id, UserSession.last_used_at).where(
+                    UserSession.user_phone == user_phone,
+                    UserSession.instance_id == instance_id
+                )
+            ).all()
+            # Newest last_used_at wins, highest id breaks ties
+            rows.sort(key=lambda r: (r.last_used_at or datetime.min, r.id), reverse=True)
+            stale_ids.extend(r.id for r in rows[1:])
+        
+        db.execute(delete(UserSession).where(UserSession.id.in_(stale_ids)))
+        db.commit()
+        logger.info(f"Removed {len(stale_ids)} duplicate user sessions")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Log database connection info
@@ -84,6 +115,19 @@ async def lifespan(app: FastAPI):
         Base.metadata.create_all(bind=engine)
         logger.info(f"✓ Successfully created {len(Base.metadata.tables)} tables")
         
+        # create_all skips indexes on tables that already exist. Older
+        # databases may hold duplicate sessions that block the unique index.
+        try:
+            dedupe_user_sessions()
+        except Exception as e:
+            logger.error(f"Could not dedupe user sessions: {e}")
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(bind=engine, checkfirst=True)
+                except Exception as e:
+                    logger.error(f"Could not create index {index.name}: {e}")
+        
         # Verify tables were created
         with engine.connect() as conn:
             if 'postgresql' in str(engine.url):
@@ -96,8 +140,12 @@ async def lifespan(app: FastAPI):
         logger.error(f"Error creating tables: {e}")
         raise
     
-    # Startup: Start the feed worker in the background
-    worker_task = asyncio.create_task(start_feed_worker())
+    # Startup: Start the feed worker in the background. It shares user_manager
+    # so status/session cache invalidations from the API apply to it too.
+    worker_task = asyncio.create_task(start_feed_worker(user_manager))
+    
+    # Evict idle Telegram clients to cap sockets and memory
+    eviction_task = asyncio.create_task(start_client_eviction())
     
     # Debug: Log user expiry on startup - REMOVED
         
@@ -105,6 +153,8 @@ async def lifespan(app: FastAPI):
     # Shutdown: Stop the feed worker
     await stop_feed_worker()
     worker_task.cancel()
+    eviction_task.cancel()
+    await payment_service.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -159,7 +209,6 @@ def create_web_session(session_id: str, phone: str, user_identifier: str, phone_
         )
         db.add(session)
         db.commit()
-        db.refresh(session)
         return session
     finally:
         db.close()
@@ -172,7 +221,6 @@ def update_web_session(session_id: str, **kwargs):
             for key, value in kwargs.items():
                 setattr(session, key, value)
             db.commit()
-            db.refresh(session)
             return session
         return None
     finally:
@@ -226,7 +274,7 @@ async def health_check():
 
 @app.post("/api/auth/send-code")
 @limiter.limit("5/minute")
-async def send_code(request: Request, body: models.SendCodeRequest, response: Response):
+async def send_code(request: Request, body: models.SendCodeRequest, response: Response, db: Session = Depends(get_db)):
     """Send authentication code to phone number."""
     # Normalize phone number (remove spaces)
     normalized_phone = body.phone.replace(" ", "")
@@ -237,7 +285,7 @@ async def send_code(request: Request, body: models.SendCodeRequest, response: Re
         
         # Check if we have a known Telegram ID for this phone
         try:
-            status = user_manager.get_subscription_status(normalized_phone)
+            status = await user_manager.aget_subscription_status(normalized_phone, db=db)
             user_identifier = str(status.telegram_id) if status.telegram_id else normalized_phone
         except Exception:
             user_identifier = normalized_phone
@@ -245,7 +293,10 @@ async def send_code(request: Request, body: models.SendCodeRequest, response: Re
             user_identifier = normalized_phone
         
         # Try to load existing session string
-        session_string = user_manager.get_session(normalized_phone, instance_id=config.INSTANCE_ID)
+        session_string = user_manager.get_session(normalized_phone, instance_id=config.INSTANCE_ID, db=db)
+        # End the read transaction so the pooled connection isn't held idle
+        # while we wait on Telegram
+        db.commit()
         manager = get_telegram_manager(user_identifier, session_string)
         result = await manager.send_code(normalized_phone)
         
@@ -285,33 +336,29 @@ async def send_code(request: Request, body: models.SendCodeRequest, response: Re
 
 @app.post("/api/auth/verify-code")
 @limiter.limit("5/minute")
-async def verify_code(request: Request, body: models.VerifyCodeRequest, response: Response):
+async def verify_code(request: Request, body: models.VerifyCodeRequest, response: Response, db: Session = Depends(get_db)):
     """Verify the authentication code."""
     # Normalize phone number (remove spaces)
     normalized_phone = body.phone.replace(" ", "")
     
     # Find session by phone and code hash
-    db = SessionLocal()
-    try:
-        # Log what we're looking for
-        logger.info(f"Looking for session with phone={normalized_phone}, phone_code_hash={body.phone_code_hash}")
-        
-        # Check all sessions for this phone
-        all_sessions = db.query(WebSession).filter(WebSession.phone == normalized_phone).all()
-        logger.info(f"Found {len(all_sessions)} sessions for phone {normalized_phone}")
-        for s in all_sessions:
-            logger.info(f"  Session {s.session_id[:8]}...: phone_code_hash={s.phone_code_hash}, authenticated={s.authenticated}")
-        
-        session = db.query(WebSession).filter(
-            WebSession.phone == normalized_phone,
-            WebSession.phone_code_hash == body.phone_code_hash
-        ).first()
-        
-        if not session:
-            logger.error(f"No matching session found for phone={normalized_phone}, phone_code_hash={body.phone_code_hash}")
-            raise HTTPException(status_code=400, detail="Invalid session")
-    finally:
-        db.close()
+    # Log what we're looking for
+    logger.info(f"Looking for session with phone={normalized_phone}, phone_code_hash={body.phone_code_hash}")
+    
+    # Check all sessions for this phone
+    all_sessions = db.query(WebSession).filter(WebSession.phone == normalized_phone).all()
+    logger.info(f"Found {len(all_sessions)} sessions for phone {normalized_phone}")
+    for s in all_sessions:
+        logger.info(f"  Session {s.session_id[:8]}...: phone_code_hash={s.phone_code_hash}, authenticated={s.authenticated}")
+    
+    session = db.query(WebSession).filter(
+        WebSession.phone == normalized_phone,
+        WebSession.phone_code_hash == body.phone_code_hash
+    ).first()
+    
+    if not session:
+        logger.error(f"No matching session found for phone={normalized_phone}, phone_code_hash={body.phone_code_hash}")
+        raise HTTPException(status_code=400, detail="Invalid session")
     
     session_id = session.session_id
     
@@ -326,7 +373,10 @@ async def verify_code(request: Request, body: models.VerifyCodeRequest, response
             logger.info(f"Received referral code: {body.referral_code}")
             
         # Try to load existing session string
-        session_string = user_manager.get_session(phone, instance_id=config.INSTANCE_ID)
+        session_string = user_manager.get_session(phone, instance_id=config.INSTANCE_ID, db=db)
+        # End the read transaction so the pooled connection isn't held idle
+        # while we wait on Telegram
+        db.commit()
         manager = get_telegram_manager(user_identifier, session_string)
         await manager.verify_code(
             body.phone,
@@ -341,7 +391,7 @@ async def verify_code(request: Request, body: models.VerifyCodeRequest, response
             logger.info(f"Authenticated as Telegram ID: {telegram_id}")
             
             # Update DB
-            user_manager.update_telegram_id(phone, telegram_id)
+            await asyncio.to_thread(user_manager.update_telegram_id, phone, telegram_id, db=db)
             
             # Rename session file if it's currently using phone number
             if manager.user_id != str(telegram_id):
@@ -364,7 +414,8 @@ async def verify_code(request: Request, body: models.VerifyCodeRequest, response
             # Save session string to DB for persistence
             session_string = await manager.get_session_string()
             if session_string:
-                user_manager.save_session(phone, session_string, instance_id=config.INSTANCE_ID)
+                user_manager.save_session(phone, session_string, instance_id=config.INSTANCE_ID, db=db)
+                manager.mark_session_persisted()
                 logger.info(f"Session string saved for phone: {phone} (instance: {config.INSTANCE_ID})")
                 
         except Exception as e:
@@ -383,9 +434,10 @@ async def verify_code(request: Request, body: models.VerifyCodeRequest, response
         
         # Ensure user exists and apply referral bonus if applicable
         is_new_user = False
+        referral_applied = False
         try:
             # Check if this is a new user
-            status, is_new_user = user_manager.get_subscription_status(phone, return_is_new=True)
+            status, is_new_user = await user_manager.aget_subscription_status(phone, return_is_new=True, db=db)
             
             # Apply referral bonus if new user OR existing user with no active sub (to fix missed referrals)
             if body.referral_code:
@@ -398,7 +450,8 @@ async def verify_code(request: Request, body: models.VerifyCodeRequest, response
                 
                 if should_apply:
                     logger.info(f"Applying referral bonus for user {phone} with code {body.referral_code}")
-                    user_manager.apply_referral_bonus(phone, body.referral_code)
+                    await asyncio.to_thread(user_manager.apply_referral_bonus, phone, body.referral_code, db=db)
+                    referral_applied = True
                 else:
                     logger.info(f"Skipping referral bonus for ineligible existing user {phone}")
         except Exception as e:
@@ -408,25 +461,25 @@ async def verify_code(request: Request, body: models.VerifyCodeRequest, response
             "success": True,
             "message": "Authentication successful",
             "is_new_user": is_new_user,
-            "referral_applied": body.referral_code and (is_new_user or status.tier == SubscriptionTier.FREE)
+            "referral_applied": referral_applied
+        }
+    except TwoFactorRequiredError:
+        # Store referral code in session if present
+        if body.referral_code:
+            update_web_session(session_id, referral_code=body.referral_code)
+            
+        # Set cookie even for 2FA so the next request can find the session
+        response.set_cookie(
+            key="session_id",
+            value=session_id,
+            **COOKIE_SETTINGS
+        )
+        return {
+            "success": False,
+            "requires_2fa": True,
+            "message": "2FA password required"
         }
     except Exception as e:
-        if "2FA_REQUIRED" in str(e):
-            # Store referral code in session if present
-            if body.referral_code:
-                update_web_session(session_id, referral_code=body.referral_code)
-                
-            # Set cookie even for 2FA so the next request can find the session
-            response.set_cookie(
-                key="session_id",
-                value=session_id,
-                **COOKIE_SETTINGS
-            )
-            return {
-                "success": False,
-                "requires_2fa": True,
-                "message": "2FA password required"
-            }
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/auth/verify-password")
@@ -435,7 +488,8 @@ async def verify_password(
     request: Request,
     body: models.VerifyPasswordRequest,
     response: Response,
-    session_id: Optional[str] = Cookie(None)
+    session_id: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
 ):
     """Verify 2FA password."""
     session = get_web_session(session_id) if session_id else None
@@ -449,14 +503,18 @@ async def verify_password(
         user_identifier = session.user_identifier
         
         # Try to load existing session string
-        session_string = user_manager.get_session(phone, instance_id=config.INSTANCE_ID)
+        session_string = user_manager.get_session(phone, instance_id=config.INSTANCE_ID, db=db)
+        # End the read transaction so the pooled connection isn't held idle
+        # while we wait on Telegram
+        db.commit()
         manager = get_telegram_manager(user_identifier, session_string)
         await manager.verify_password(body.password)
         
         # After successful verification, save the session string
         session_string = await manager.get_session_string()
         if session_string:
-            user_manager.save_session(phone, session_string, instance_id=config.INSTANCE_ID)
+            user_manager.save_session(phone, session_string, instance_id=config.INSTANCE_ID, db=db)
+            manager.mark_session_persisted()
             logger.info(f"Session string saved for phone: {phone} (instance: {config.INSTANCE_ID})")
         
         update_web_session(session_id, authenticated=True)
@@ -465,7 +523,7 @@ async def verify_password(
         if session.referral_code:
             try:
                 # Check if this is a new user
-                status, is_new_user = user_manager.get_subscription_status(phone, return_is_new=True)
+                status, is_new_user = await user_manager.aget_subscription_status(phone, return_is_new=True, db=db)
                 
                 should_apply = is_new_user
                 if not should_apply:
@@ -476,7 +534,7 @@ async def verify_password(
 
                 if should_apply:
                     logger.info(f"Applying referral bonus for user {phone} with code {session.referral_code} (after 2FA)")
-                    user_manager.apply_referral_bonus(phone, session.referral_code)
+                    await asyncio.to_thread(user_manager.apply_referral_bonus, phone, session.referral_code, db=db)
                 else:
                     logger.info(f"Skipping referral bonus for ineligible existing user {phone} (after 2FA)")
                     
@@ -561,6 +619,8 @@ async def list_channels(response: Response, session_id: Optional[str] = Cookie(N
         await handle_revoked_session(session_id, session.phone)
         response.delete_cookie("session_id")
         raise HTTPException(status_code=401, detail="Telegram session revoked. Please login again.")
+    except NotAuthenticatedError as e:
+        raise HTTPException(status_code=401, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -584,6 +644,8 @@ async def list_folders(response: Response, session_id: Optional[str] = Cookie(No
         await handle_revoked_session(session_id, session.phone)
         response.delete_cookie("session_id")
         raise HTTPException(status_code=401, detail="Telegram session revoked. Please login again.")
+    except NotAuthenticatedError as e:
+        raise HTTPException(status_code=401, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -616,6 +678,8 @@ async def get_channel_photo(
         await handle_revoked_session(session_id, session.phone)
         response.delete_cookie("session_id")
         raise HTTPException(status_code=401, detail="Telegram session revoked. Please login again.")
+    except NotAuthenticatedError as e:
+        raise HTTPException(status_code=401, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
@@ -649,6 +713,8 @@ async def create_channel(
         await handle_revoked_session(session_id, session.phone)
         response.delete_cookie("session_id")
         raise HTTPException(status_code=401, detail="Telegram session revoked. Please login again.")
+    except NotAuthenticatedError as e:
+        raise HTTPException(status_code=401, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -718,7 +784,7 @@ async def create_feed(
         phone = session.phone
         
         # Check subscription limits
-        sub_status = user_manager.get_subscription_status(phone)
+        sub_status = await user_manager.aget_subscription_status(phone)
         user_feeds = feed_config_manager.get_user_feeds(phone)
         
         # Determine if this feed should be active
@@ -775,7 +841,7 @@ async def update_feed(
     
     try:
         phone = session.phone
-        sub_status = user_manager.get_subscription_status(phone)
+        sub_status = await user_manager.aget_subscription_status(phone)
         is_premium = sub_status.tier in [SubscriptionTier.PREMIUM, SubscriptionTier.PREMIUM_BASIC, SubscriptionTier.PREMIUM_ADVANCED, SubscriptionTier.TRIAL]
         
         updates = update_request.model_dump(exclude_unset=True)
@@ -884,7 +950,7 @@ async def toggle_feed(
         
         if new_active:
             # Check limits if turning ON
-            sub_status = user_manager.get_subscription_status(phone)
+            sub_status = await user_manager.aget_subscription_status(phone)
             is_premium = sub_status.tier in [SubscriptionTier.PREMIUM, SubscriptionTier.PREMIUM_BASIC, SubscriptionTier.PREMIUM_ADVANCED, SubscriptionTier.TRIAL]
             
             # Check filters
@@ -971,7 +1037,7 @@ async def import_feeds(
             raise HTTPException(status_code=400, detail="No feeds found in import data")
             
         # Check subscription limits
-        sub_status = user_manager.get_subscription_status(phone)
+        sub_status = await user_manager.aget_subscription_status(phone)
         current_feeds = feed_config_manager.get_user_feeds(phone)
         
         imported_count = 0
@@ -1016,7 +1082,7 @@ async def import_feeds(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/subscription")
-async def get_subscription(request: Request):
+async def get_subscription(request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """Get current user subscription status."""
     session_id = request.cookies.get("session_id")
     session = get_web_session(session_id) if session_id else None
@@ -1024,19 +1090,21 @@ async def get_subscription(request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     phone = session.phone
-    status = user_manager.get_subscription_status(phone)
+    status = await user_manager.aget_subscription_status(phone, db=db)
     
     # Handle expired trial auto-downgrade with feed management
     if status.is_expired and status.tier == SubscriptionTier.TRIAL:
-        user_manager.downgrade_to_free(phone, feed_config_manager)
+        await asyncio.to_thread(user_manager.downgrade_to_free, phone, db=db)
+        # Feed restrictions don't affect the returned status; settle them after responding
+        background_tasks.add_task(user_manager.reconcile_feeds_after_downgrade, phone, feed_config_manager)
         # Reload status after downgrade
-        status = user_manager.get_subscription_status(phone)
+        status = await user_manager.aget_subscription_status(phone, db=db)
     
     return status
 
 @app.post("/api/subscription/activate-trial")
 @limiter.limit("10/minute")
-async def activate_trial(request: Request):
+async def activate_trial(request: Request, db: Session = Depends(get_db)):
     """Activate 3-day trial for current user."""
     session_id = request.cookies.get("session_id")
     session = get_web_session(session_id) if session_id else None
@@ -1046,8 +1114,8 @@ async def activate_trial(request: Request):
     phone = session.phone
     
     try:
-        user_manager.start_trial(phone)
-        return user_manager.get_subscription_status(phone)
+        await asyncio.to_thread(user_manager.start_trial, phone, db=db)
+        return await user_manager.aget_subscription_status(phone, db=db)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -1060,7 +1128,7 @@ async def upgrade_subscription(request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     phone = session.phone
-    user_manager.upgrade_to_premium(phone, payment_method="manual")
+    await asyncio.to_thread(user_manager.upgrade_to_premium, phone, payment_method="manual")
     return {"status": "success", "tier": "premium"}
 
 @app.get("/api/referral")
@@ -1072,7 +1140,7 @@ async def get_referral_info(request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     phone = session.phone
-    info = user_manager.get_referral_info(phone)
+    info = await user_manager.aget_referral_info(phone)
     if not info:
         raise HTTPException(status_code=404, detail="User not found")
         
@@ -1098,14 +1166,15 @@ async def notify_admin_subscription(phone: str, tier: str, amount: Any, currency
     """Notify admin about new subscription."""
     try:
         admin_phone = config.ADMIN_PHONE
-        # Look up admin's telegram ID
-        user = user_manager.get_user_by_phone(phone)
+        # Look up the user's and admin's telegram IDs in one query
+        users = await asyncio.to_thread(user_manager.get_users_by_phones, [phone, admin_phone])
+        user = users.get(phone)
         if user and user.telegram_id:
             user_str = f"{phone} (ID: {user.telegram_id})"
         else:
             user_str = phone
             
-        admin = user_manager.get_user_by_phone(admin_phone)
+        admin = users.get(admin_phone)
         if admin and admin.telegram_id:
             admin_id = admin.telegram_id
             
@@ -1136,7 +1205,7 @@ async def test_admin_notify(request: Request, phone: str = Body(..., embed=True)
 
 @app.post("/api/payment/create-invoice")
 @limiter.limit("10/minute")
-async def create_payment_invoice(request: Request):
+async def create_payment_invoice(request: Request, db: Session = Depends(get_db)):
     """
     Create and send payment invoice to user
     
@@ -1152,13 +1221,17 @@ async def create_payment_invoice(request: Request):
     try:
         # Get user's Telegram ID from their session
         user_identifier = session.user_identifier or phone
-        manager = get_telegram_manager(user_identifier)
-        client = await manager.initialize()
-        me = await client.get_me()
+        session_string = user_manager.get_session(phone, instance_id=config.INSTANCE_ID, db=db)
+        # End the read transaction so the pooled connection isn't held idle
+        # while we wait on Telegram
+        db.commit()
+        manager = get_telegram_manager(user_identifier, session_string)
+        await manager.ensure_connected()
+        me = await manager.client.get_me()
         telegram_user_id = me.id
         
         # Link Telegram ID to user for future webhook lookup
-        user_manager.link_telegram_id(phone, telegram_user_id)
+        await asyncio.to_thread(user_manager.link_telegram_id, phone, telegram_user_id, db=db)
         
         # Send invoice
         # Default to Advanced if not specified (or handle payload logic)
@@ -1182,7 +1255,7 @@ async def create_payment_invoice(request: Request):
         # Calculate price based on payload
         if payload == "premium_advanced_upgrade":
             # Dynamic Upgrade + Extend Logic
-            user = user_manager.get_user_by_phone(phone)
+            user = user_manager.get_user_by_phone(phone, db=db)
             remaining_days = (user.expiry_date - datetime.utcnow()).days if user.expiry_date else 0
             import math
             existing_months = math.ceil(remaining_days / 30.0)
@@ -1238,6 +1311,8 @@ async def create_payment_invoice(request: Request):
         # Encode duration in payload for webhook
         encoded_payload = f"{payload}:{duration_months}"
 
+        # Release the connection before the Bot API round-trip
+        db.commit()
         result = await payment_service.create_invoice(
             chat_id=telegram_user_id,
             title=title,
@@ -1265,6 +1340,9 @@ async def payment_webhook(
 ):
     """
     Handle Telegram payment webhook updates
+    
+    Each branch makes a single UserManager call with its own short-lived
+    session, so no transaction is held across the Bot API round-trips.
     """
     try:
         body = await request.body()
@@ -1278,7 +1356,7 @@ async def payment_webhook(
             logger.warning("Invalid webhook signature")
             raise HTTPException(status_code=403, detail="Invalid signature")
         
-        update = json.loads(body_str)
+        update = orjson.loads(body)
         logger.info(f"Received payment webhook: {update}")
         
         # Handle pre-checkout query
@@ -1349,17 +1427,24 @@ async def payment_webhook(
                 
                 try:
                     # Find user by Telegram ID
-                    phone = user_manager.get_phone_by_telegram_id(user_id)
+                    phone = await user_manager.aget_phone_by_telegram_id(user_id)
                     
                     if phone:
-                        user_manager.upgrade_to_premium(phone, payment_method="stars", tier=tier, duration_days=duration_days)
+                        # Sync SQLAlchemy write, so run it in a thread with its own session.
+                        # Notify only once it has succeeded.
+                        await asyncio.to_thread(
+                            user_manager.upgrade_to_premium,
+                            phone, payment_method="stars", tier=tier, duration_days=duration_days
+                        )
                         logger.info(f"User {phone} (ID: {user_id}) upgraded to premium")
                         
-                        await notify_admin_subscription(phone, str(tier), amount, currency, "Telegram Stars")
-                        
-                        await payment_service.send_message(
-                            user_id, 
-                            "✅ Payment received! You are now Premium."
+                        # Overlap the admin notification with the user's confirmation
+                        await asyncio.gather(
+                            notify_admin_subscription(phone, str(tier), amount, currency, "Telegram Stars"),
+                            payment_service.send_message(
+                                user_id, 
+                                "✅ Payment received! You are now Premium."
+                            )
                         )
                     else:
                         logger.error(f"Could not find user for Telegram ID {user_id}")
@@ -1382,7 +1467,7 @@ async def payment_webhook(
                 if args and args[0] == "upgrade":
                     # User clicked the deep link for upgrade
                     # Check if we know this user
-                    phone = user_manager.get_phone_by_telegram_id(chat_id)
+                    phone = await user_manager.aget_phone_by_telegram_id(chat_id)
                     if not phone:
                         await payment_service.send_message(
                             chat_id,
@@ -1440,7 +1525,7 @@ async def payment_webhook(
             
         return {"ok": True}
         
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error("Invalid JSON in webhook")
         raise HTTPException(status_code=400, detail="Invalid JSON")
     except Exception as e:
@@ -1459,7 +1544,7 @@ async def get_payment_status(request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     phone = session.phone
-    sub_status = user_manager.get_subscription_status(phone)
+    sub_status = await user_manager.aget_subscription_status(phone)
     
     return {
         "tier": sub_status.tier,
@@ -1590,9 +1675,10 @@ async def create_stripe_checkout(request: Request):
         telegram_id = None
         try:
             user_identifier = session.user_identifier or phone
-            manager = get_telegram_manager(user_identifier)
-            client = await manager.initialize()
-            me = await client.get_me()
+            session_string = user_manager.get_session(phone, instance_id=config.INSTANCE_ID)
+            manager = get_telegram_manager(user_identifier, session_string)
+            await manager.ensure_connected()
+            me = await manager.client.get_me()
             telegram_id = me.id
         except Exception as e:
             logger.warning(f"Could not get Telegram ID: {e}")
@@ -1647,7 +1733,7 @@ async def create_stripe_checkout(request: Request):
 
 @app.post("/api/payment/stripe-upgrade-checkout")
 @limiter.limit("10/minute")
-async def create_upgrade_checkout(request: Request):
+async def create_upgrade_checkout(request: Request, db: Session = Depends(get_db)):
     """
     Create a checkout session for upgrading to Advanced (Dynamic Pricing)
     """
@@ -1660,7 +1746,7 @@ async def create_upgrade_checkout(request: Request):
     
     try:
         # Get user to find existing subscription
-        user = user_manager.get_user_by_phone(phone)
+        user = user_manager.get_user_by_phone(phone, db=db)
         if not user or not user.stripe_subscription_id:
             # If no Stripe subscription, we can't "upgrade" the existing one easily via this flow
             # But maybe they want to switch payment method?
@@ -1675,7 +1761,7 @@ async def create_upgrade_checkout(request: Request):
 
         # Calculate upgrade cost
         target_tier = SubscriptionTier.PREMIUM_ADVANCED
-        cost_data = user_manager.calculate_upgrade_cost(phone, target_tier)
+        cost_data = user_manager.calculate_upgrade_cost(phone, target_tier, db=db)
         amount_eur = cost_data["amount"]
         amount_cents = int(amount_eur * 100)
         description = cost_data["description"]
@@ -1762,7 +1848,7 @@ async def verify_stripe_payment(
                     tier = SubscriptionTier.PREMIUM_ADVANCED
                     duration_days = 365
 
-                user_manager.upgrade_to_premium(phone, payment_method="stripe", tier=tier, duration_days=duration_days)
+                await asyncio.to_thread(user_manager.upgrade_to_premium, phone, payment_method="stripe", tier=tier, duration_days=duration_days)
                 logger.info(f"User {phone} upgraded to Premium via Stripe verification (payload: {payload})")
                 await notify_admin_subscription(phone, str(tier), "Standard/Unknown", "EUR", "Stripe (Verification)")
                 return {"success": True, "status": "paid"}
@@ -1823,7 +1909,8 @@ async def stripe_webhook(request: Request):
                     )
                     
                     # Update local user tier
-                    user_manager.upgrade_to_premium(
+                    await asyncio.to_thread(
+                        user_manager.upgrade_to_premium,
                         phone, 
                         payment_method="stripe", 
                         tier=SubscriptionTier.PREMIUM_ADVANCED,
@@ -1853,7 +1940,8 @@ async def stripe_webhook(request: Request):
                 stripe_subscription_id = session.get("subscription")
 
                 # Upgrade user to Premium
-                user_manager.upgrade_to_premium(
+                await asyncio.to_thread(
+                    user_manager.upgrade_to_premium,
                     phone, 
                     payment_method="stripe", 
                     tier=tier, 
@@ -2055,7 +2143,7 @@ async def tbank_webhook(request: Request):
                             duration_days = 365
                     
                     # Upgrade user to premium
-                    user_manager.upgrade_to_premium(phone, payment_method="tbank", tier=tier, duration_days=duration_days)
+                    await asyncio.to_thread(user_manager.upgrade_to_premium, phone, payment_method="tbank", tier=tier, duration_days=duration_days)
                     
                     logger.info(f"Upgraded user {phone} to Premium via T-Bank payment {payment_id}")
                     await notify_admin_subscription(phone, str(tier), result.get("amount", 0)/100, "RUB", "T-Bank")
@@ -2222,7 +2310,7 @@ async def coinbase_webhook(request: Request):
                     tier = models.SubscriptionTier.PREMIUM_ADVANCED
                     duration_days = 365
                 
-                user_manager.upgrade_to_premium(phone, payment_method="coinbase", tier=tier, duration_days=duration_days)
+                await asyncio.to_thread(user_manager.upgrade_to_premium, phone, payment_method="coinbase", tier=tier, duration_days=duration_days)
                 logger.info(f"Upgraded user {phone} to Premium via Coinbase")
                 await notify_admin_subscription(phone, str(tier), "Crypto", "EUR", "Coinbase")
             else:
@@ -1,6 +1,9 @@
 import redis
 import os
 import time
+import threading
+import logging
+import orjson
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -8,9 +11,98 @@ load_dotenv()
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
+logger = logging.getLogger(__name__)
+
 # Create Redis client
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
 
+# Separate client for the read-through cache: short timeouts so a down Redis
+# costs a fraction of a second instead of stalling the caller
+REDIS_CACHE_TIMEOUT = float(os.getenv("REDIS_CACHE_TIMEOUT", "0.2"))
+# Seconds to skip the cache after a failure before trying Redis again
+REDIS_CACHE_BACKOFF = float(os.getenv("REDIS_CACHE_BACKOFF", "30"))
+
+cache_client = redis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    socket_connect_timeout=REDIS_CACHE_TIMEOUT,
+    socket_timeout=REDIS_CACHE_TIMEOUT,
+)
+
+class RedisCache:
+    """
+    Shared JSON value cache. Redis errors are treated as a miss and disable
+    the cache for REDIS_CACHE_BACKOFF seconds. Deletes that could not reach
+    Redis are queued: those keys read as a miss until the delete is replayed
+    on the next successful call, so stale values are never served.
+    
+    The client is synchronous; event-loop callers go through asyncio.to_thread.
+    """
+    
+    _disabled_until = 0.0
+    _pending_deletes: set = set()
+    _lock = threading.Lock()
+    
+    @classmethod
+    def _available(cls) -> bool:
+        return time.monotonic() >= cls._disabled_until
+    
+    @classmethod
+    def _failed(cls, op: str, e: Exception):
+        if cls._available():
+            logger.warning(f"Redis cache {op} failed, disabling cache for {REDIS_CACHE_BACKOFF:.0f}s: {e}")
+        cls._disabled_until = time.monotonic() + REDIS_CACHE_BACKOFF
+    
+    @classmethod
+    def _flush_pending(cls):
+        """Replay queued deletes. Raises redis.RedisError if Redis is still down."""
+        with cls._lock:
+            keys = list(cls._pending_deletes)
+        if not keys:
+            return
+        cache_client.delete(*keys)
+        with cls._lock:
+            cls._pending_deletes.difference_update(keys)
+        logger.info(f"Replayed {len(keys)} queued Redis cache deletes")
+    
+    @classmethod
+    def get(cls, key: str):
+        if not cls._available():
+            return None
+        with cls._lock:
+            if key in cls._pending_deletes:
+                return None
+        try:
+            cls._flush_pending()
+            value = cache_client.get(key)
+        except redis.RedisError as e:
+            cls._failed("get", e)
+            return None
+        return orjson.loads(value) if value is not None else None
+    
+    @classmethod
+    def set(cls, key: str, value, ttl: int):
+        if not cls._available():
+            return
+        try:
+            cls._flush_pending()
+            cache_client.set(key, orjson.dumps(value), ex=ttl)
+        except redis.RedisError as e:
+            cls._failed("set", e)
+    
+    @classmethod
+    def delete(cls, *keys: str):
+        if not keys:
+            return
+        with cls._lock:
+            cls._pending_deletes.update(keys)
+        if not cls._available():
+            return
+        try:
+            cls._flush_pending()
+        except redis.RedisError as e:
+            cls._failed("delete", e)
+
 class RateLimiter:
     """Distributed rate limiter using Redis."""
     
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, JSON, DateTime, ForeignKey, BigInteger
+from sqlalchemy import Boolean, Column, Integer, String, JSON, DateTime, ForeignKey, BigInteger, Index
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -27,7 +27,7 @@ class Feed(Base):
     __tablename__ = "feeds"
 
     id = Column(String, primary_key=True, index=True)
-    user_id = Column(String, ForeignKey("users.phone", ondelete="CASCADE"))
+    user_id = Column(String, ForeignKey("users.phone", ondelete="CASCADE"), index=True)
     name = Column(String)
     source_channel_ids = Column(JSON)  # List of integers
     destination_channel_id = Column(BigInteger)
@@ -53,6 +53,11 @@ class UserSession(Base):
     # Relationship
     user = relationship("User", back_populates="sessions")
 
+    # One session per (user, instance); target of the save_session upsert
+    __table_args__ = (
+        Index("ix_user_sessions_phone_instance", "user_phone", "instance_id", unique=True),
+    )
+
 # Update User to have relationship
 User.sessions = relationship("UserSession", back_populates="user", cascade="all, delete-orphan")
 
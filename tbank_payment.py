@@ -7,6 +7,7 @@ Handles payment processing using T-Bank Acquiring API for Russian ruble payments
 import logging
 import hashlib
 import httpx
+import orjson
 from typing import Dict, Any, Optional
 from datetime import datetime
 
@@ -141,7 +142,7 @@ class TBankPaymentService:
                 try:
                     # Log the raw response for debugging
                     logger.info(f"T-Bank Init response: {response.text}")
-                    result = response.json()
+                    result = orjson.loads(response.content)
                 except Exception:
                     logger.error(f"Failed to decode T-Bank response: {response.status_code} - {response.text}")
                     raise Exception(f"T-Bank API error ({response.status_code}): {response.text[:200]}")
@@ -193,7 +194,7 @@ class TBankPaymentService:
                 response = await client.post(url, json=params)
                 # Log the raw response for debugging
                 logger.info(f"T-Bank GetState response: {response.text}")
-                result = response.json()
+                result = orjson.loads(response.content)
                 
                 if not result.get("Success"):
                     logger.error(f"T-Bank GetState error: {result}")
@@ -1,15 +1,127 @@
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
 from telethon.errors import SessionPasswordNeededError
 from telethon.tl.functions.channels import CreateChannelRequest
-from telethon.tl.types import Channel, ChatPhotoEmpty, UserProfilePhotoEmpty
+from telethon.tl.types import (
+    Channel, Chat, ChatPhotoEmpty, UserProfilePhotoEmpty,
+    PeerChannel, PeerChat, InputPeerChannel, InputPeerChat
+)
 from telethon.sessions import StringSession
 from typing import Optional, List, Dict
 import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
 from pathlib import Path
 import config
 import logging
 
 logger = logging.getLogger(__name__)
+
+class NotAuthenticatedError(Exception):
+    """Raised when an operation requires an authorized Telegram session."""
+    def __init__(self, message: str = "Not authenticated"):
+        super().__init__(message)
+
+class TwoFactorRequiredError(Exception):
+    """Raised by verify_code when the account is protected by a 2FA password."""
+    def __init__(self, message: str = "2FA_REQUIRED"):
+        super().__init__(message)
+
+# Seconds between sweeps of expired files from the photo cache
+PHOTO_PRUNE_INTERVAL = 3600
+
+# Type tuples for single-call isinstance checks in the dialog loop
+_CHANNEL_TYPES = (Channel, Chat)
+_EMPTY_PHOTOS = (ChatPhotoEmpty, UserProfilePhotoEmpty)
+
+def _channel_to_dict(entity) -> Dict[str, any]:
+    """Build the API representation of a Channel/Chat entity."""
+    # Branch on the type once and read attributes directly:
+    # only Channel has `username` and `broadcast`
+    if isinstance(entity, Channel):
+        username = entity.username
+        typ = "channel" if entity.broadcast else "group"
+    else:  # Chat
+        username = None
+        typ = "group"
+    
+    # Check if photo exists and is not empty
+    photo = entity.photo
+    return {
+        "id": entity.id,
+        "title": entity.title,
+        "username": username,
+        "type": typ,
+        "member_count": entity.participants_count,
+        "has_photo": photo is not None and not isinstance(photo, _EMPTY_PHOTOS)
+    }
+
+def _normalize_peer_id(peer) -> int:
+    """
+    Return the bare ID of a folder peer (no -100 / - marker) so it
+    matches the IDs returned by get_channels.
+    """
+    # Handle InputPeer types which are common in DialogFilters
+    if isinstance(peer, (PeerChannel, InputPeerChannel)):
+        return peer.channel_id
+    if isinstance(peer, (PeerChat, InputPeerChat)):
+        return peer.chat_id
+    
+    raw_id = utils.get_peer_id(peer)
+    
+    # Fallback: if utils.get_peer_id returned a marked ID (starts with -100), strip it
+    # This is a safety net if the above types didn't catch it
+    if isinstance(raw_id, int) and raw_id < 0:
+        # Convert -1001234567890 to 1234567890
+        s_id = str(raw_id)
+        if s_id.startswith("-100"):
+            raw_id = int(s_id[4:])
+        else:
+            raw_id = int(s_id[1:])
+    return raw_id
+
+def _read_cached_photo(cache_path: Path) -> Optional[bytes]:
+    """Return the cached photo if it exists and is younger than PHOTO_CACHE_TTL."""
+    try:
+        if time.time() - cache_path.stat().st_mtime < config.PHOTO_CACHE_TTL:
+            return cache_path.read_bytes()
+    except FileNotFoundError:
+        pass
+    return None
+
+def _store_photo(tmp_path: Path, cache_path: Path) -> bytes:
+    """Move a finished download into place and drop the channel's older photos."""
+    data = tmp_path.read_bytes()
+    os.replace(tmp_path, cache_path)
+    for old_path in cache_path.parent.glob("*.jpg"):
+        if old_path != cache_path:
+            old_path.unlink(missing_ok=True)
+    return data
+
+def prune_photo_cache() -> int:
+    """
+    Delete cached photos (and leftover temp files) older than PHOTO_CACHE_TTL
+    and remove emptied channel directories. Returns the number of files removed.
+    """
+    cutoff = time.time() - config.PHOTO_CACHE_TTL
+    removed = 0
+    for entry in config.PHOTO_CACHE_DIR.iterdir():
+        paths = list(entry.iterdir()) if entry.is_dir() else [entry]
+        for path in paths:
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if entry.is_dir():
+            try:
+                entry.rmdir()
+            except OSError:
+                pass  # Still holds fresh photos
+    return removed
+
 class TelegramManager:
     """Manages Telegram client sessions and operations."""
     
@@ -18,6 +130,17 @@ class TelegramManager:
         self.session_string = session_string
         self.client: Optional[TelegramClient] = None
         self._is_connected = False
+        # Serialized StringSession, reset whenever the session may change
+        self._session_string_cache: Optional[str] = None
+        # Monotonic timestamp of the last registry lookup (for idle eviction)
+        self.last_used = time.monotonic()
+        # False while a login is in flight: the auth key only lives in memory
+        # until the caller stores the session string (see mark_session_persisted)
+        self.session_persisted = session_string is not None
+        # Serializes connect attempts from concurrent requests
+        self._connect_lock = asyncio.Lock()
+        # Caps concurrent media downloads to stay under Telegram's flood limits
+        self._dl_sem = asyncio.Semaphore(config.TELEGRAM_DL_CONCURRENCY)
         
     async def initialize(self) -> TelegramClient:
         """Initialize the Telegram client."""
@@ -36,9 +159,19 @@ class TelegramManager:
     
     async def ensure_connected(self):
         """Ensure the client is connected."""
-        await self.initialize()
-        if not self.client.is_connected():
-            await self.client.connect()
+        # Fast path: already initialized and connected, nothing to await
+        if self.client is not None and self.client.is_connected():
+            return
+        async with self._connect_lock:
+            await self.initialize()
+            # Re-check: another caller may have connected while we waited
+            if not self.client.is_connected():
+                await self.client.connect()
+                self._session_string_cache = None
+
+    def mark_session_persisted(self):
+        """Record that the current session string has been saved to the DB."""
+        self.session_persisted = True
 
     async def send_code(self, phone: str) -> Dict[str, any]:
         """Send authentication code to phone number."""
@@ -62,6 +195,7 @@ class TelegramManager:
             # Retry once if connection failed
             await self.client.disconnect()
             await self.client.connect()
+            self._session_string_cache = None
             result = await self.client.send_code_request(phone)
             logger.info(f"Code sent successfully after retry. Hash: {result.phone_code_hash}")
             
@@ -77,10 +211,11 @@ class TelegramManager:
         try:
             await self.client.sign_in(phone, code, phone_code_hash=phone_code_hash)
             self._is_connected = True
+            self._session_string_cache = None
             return True
         except SessionPasswordNeededError:
             # 2FA is enabled, need password
-            raise Exception("2FA_REQUIRED")
+            raise TwoFactorRequiredError()
         except Exception as e:
             raise Exception(f"Verification failed: {str(e)}")
     
@@ -90,6 +225,7 @@ class TelegramManager:
         try:
             await self.client.sign_in(password=password)
             self._is_connected = True
+            self._session_string_cache = None
             return True
         except Exception as e:
             raise Exception(f"Password verification failed: {str(e)}")
@@ -98,15 +234,13 @@ class TelegramManager:
         """Get the current session string."""
         if not self.client:
             return None
-        return StringSession.save(self.client.session)
+        if self._session_string_cache is None:
+            self._session_string_cache = StringSession.save(self.client.session)
+        return self._session_string_cache
 
     async def is_authenticated(self) -> bool:
         """Check if user is authenticated."""
-        if not self.client:
-            await self.initialize()
-        
-        if not self.client.is_connected():
-            await self.client.connect()
+        await self.ensure_connected()
         
         is_auth = await self.client.is_user_authorized()
         logger.info(f"Checking auth for {self.user_id}. Connected: {self.client.is_connected()}. Authorized: {is_auth}")
@@ -115,37 +249,20 @@ class TelegramManager:
     async def get_channels(self) -> List[Dict[str, any]]:
         """Get list of channels/groups the user has joined."""
         if not await self.is_authenticated():
-            raise Exception("Not authenticated")
+            raise NotAuthenticatedError()
         
         dialogs = await self.client.get_dialogs()
-        channels = []
-        
-        from telethon.tl.types import Channel, Chat
-        
-        for dialog in dialogs:
-            entity = dialog.entity
-            # Include channels, supergroups, and groups
-            if isinstance(entity, Channel) or isinstance(entity, Chat):
-                # Check if photo exists and is not empty
-                has_photo = hasattr(entity, 'photo') and entity.photo is not None and not isinstance(entity.photo, ChatPhotoEmpty) and not isinstance(entity.photo, UserProfilePhotoEmpty)
-                
-                channels.append({
-                    "id": entity.id,
-                    "title": entity.title,
-                    "username": getattr(entity, 'username', None),
-                    "type": "channel" if getattr(entity, 'broadcast', False) else "group",
-                    "member_count": getattr(entity, 'participants_count', None),
-                    "has_photo": has_photo
-                })
-                # Debug logging
-                # logger.info(f"Channel {entity.title} -> ID: {entity.id}")
-        
-        return channels
+        # Include channels, supergroups, and groups
+        return [
+            _channel_to_dict(dialog.entity)
+            for dialog in dialogs
+            if isinstance(dialog.entity, _CHANNEL_TYPES)
+        ]
     
     async def create_channel(self, title: str, about: str = "") -> Dict[str, any]:
         """Create a new private channel."""
         if not await self.is_authenticated():
-            raise Exception("Not authenticated")
+            raise NotAuthenticatedError()
         
         result = await self.client(CreateChannelRequest(
             title=title,
@@ -161,31 +278,48 @@ class TelegramManager:
         }
     
     async def get_channel_photo(self, channel_id: int) -> Optional[bytes]:
-        """Download channel profile photo."""
+        """Download channel profile photo (cached on disk)."""
         if not await self.is_authenticated():
-            raise Exception("Not authenticated")
+            raise NotAuthenticatedError()
             
+        tmp_path = None
         try:
             # Get the entity (channel/group)
             entity = await self.client.get_entity(channel_id)
+            photo_id = getattr(getattr(entity, 'photo', None), 'photo_id', None)
+            if photo_id is None:
+                return None
             
-            # Download profile photo into memory
-            from io import BytesIO
-            out = BytesIO()
-            await self.client.download_profile_photo(entity, out, download_big=False)
-            return out.getvalue()
+            # Serve from the disk cache if fresh. Photos live in a per-channel
+            # directory keyed by photo id, so a changed photo never hits a stale entry.
+            channel_dir = config.PHOTO_CACHE_DIR / str(channel_id)
+            cache_path = channel_dir / f"{photo_id}.jpg"
+            data = await asyncio.to_thread(_read_cached_photo, cache_path)
+            if data is not None:
+                return data
+            
+            # Download to a temp file and move it into place only once it is
+            # complete, so readers never see a truncated cache entry
+            await asyncio.to_thread(channel_dir.mkdir, exist_ok=True)
+            tmp_path = channel_dir / f".{photo_id}.{uuid.uuid4().hex}.tmp"
+            async with self._dl_sem:
+                path = await self.client.download_profile_photo(entity, str(tmp_path), download_big=False)
+            if not path:
+                return None
+            return await asyncio.to_thread(_store_photo, Path(path), cache_path)
         except Exception as e:
             logger.error(f"Error fetching photo for {channel_id}: {e}")
+            if tmp_path is not None:
+                await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
             return None
 
     async def get_dialog_filters(self) -> List[Dict[str, any]]:
         """Get list of dialog filters (folders)."""
         if not await self.is_authenticated():
-            raise Exception("Not authenticated")
+            raise NotAuthenticatedError()
         
         from telethon.tl.functions.messages import GetDialogFiltersRequest
-        from telethon.tl.types import DialogFilter, DialogFilterChatlist, DialogFilterDefault, PeerChannel, PeerChat, InputPeerChannel, InputPeerChat
-        from telethon import utils
+        from telethon.tl.types import DialogFilter, DialogFilterChatlist, DialogFilterDefault
         
         result = await self.client(GetDialogFiltersRequest())
         
@@ -207,42 +341,9 @@ class TelegramManager:
                 title = title.text
                 
             if isinstance(f, DialogFilter):
-                included_peers = []
-                for peer in f.include_peers:
-                    peer_id = utils.get_peer_id(peer)
-                    
-                    # Normalize ID: remove -100 prefix for channels if present
-                    # We need bare IDs to match get_channels output
-                    
-                    raw_id = peer_id
-                    
-                    # Handle InputPeer types which are common in DialogFilters
-                    if isinstance(peer, (PeerChannel, InputPeerChannel)):
-                         if hasattr(peer, 'channel_id'):
-                             raw_id = peer.channel_id
-                    elif isinstance(peer, (PeerChat, InputPeerChat)):
-                         if hasattr(peer, 'chat_id'):
-                             raw_id = peer.chat_id
-                    
-                    # Fallback: if utils.get_peer_id returned a marked ID (starts with -100), try to strip it
-                    # This is a safety net if the above types didn't catch it
-                    if isinstance(raw_id, int) and raw_id < 0:
-                        # Convert -1001234567890 to 1234567890
-                        s_id = str(raw_id)
-                        if s_id.startswith("-100"):
-                            try:
-                                raw_id = int(s_id[4:])
-                            except:
-                                pass
-                        elif s_id.startswith("-"):
-                             try:
-                                raw_id = int(s_id[1:])
-                             except:
-                                pass
-                    
-                    # Debug logging
-                    logger.info(f"Folder {title} peer: {peer} -> ID: {peer_id} -> Raw: {raw_id}")
-                    included_peers.append(raw_id)
+                included_peers = [_normalize_peer_id(peer) for peer in f.include_peers]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Folder %s peers: %s", title, included_peers)
                 
                 filters.append({
                     "id": f.id,
@@ -264,22 +365,77 @@ class TelegramManager:
         if self.client and self.client.is_connected():
             await self.client.disconnect()
             self._is_connected = False
+            self._session_string_cache = None
 
 
-# Global registry of active clients
-_active_clients: Dict[str, TelegramManager] = {}
+# Global registry of active clients, least recently used first
+_active_clients: "OrderedDict[str, TelegramManager]" = OrderedDict()
 
 def get_telegram_manager(user_id: str, session_string: str = None) -> TelegramManager:
     """Get or create a TelegramManager for a user."""
-    if user_id not in _active_clients:
-        _active_clients[user_id] = TelegramManager(user_id, session_string)
-    return _active_clients[user_id]
+    manager = _active_clients.get(user_id)
+    if manager is None:
+        manager = TelegramManager(user_id, session_string)
+        _active_clients[user_id] = manager
+    else:
+        _active_clients.move_to_end(user_id)
+    manager.last_used = time.monotonic()
+    return manager
 
 async def cleanup_client(user_id: str):
     """Cleanup and remove a client from the registry."""
-    if user_id in _active_clients:
-        await _active_clients[user_id].disconnect()
-        del _active_clients[user_id]
+    manager = _active_clients.pop(user_id, None)
+    if manager:
+        await manager.disconnect()
+
+async def evict_stale_clients():
+    """
+    Disconnect clients idle for longer than TELEGRAM_CLIENT_TTL and trim the
+    registry down to TELEGRAM_MAX_CLIENTS, least recently used first.
+    Clients with registered event handlers (feed worker listeners) are kept,
+    and clients whose session has not been persisted yet (mid-login) are only
+    dropped once idle past the TTL, never to trim the registry.
+    """
+    now = time.monotonic()
+    excess = len(_active_clients) - config.TELEGRAM_MAX_CLIENTS
+    stale = []
+    for user_id, manager in _active_clients.items():
+        if manager.client is not None and manager.client.list_event_handlers():
+            continue
+        if now - manager.last_used > config.TELEGRAM_CLIENT_TTL:
+            stale.append(user_id)
+            excess -= 1
+        elif excess > 0 and manager.session_persisted:
+            stale.append(user_id)
+            excess -= 1
+    
+    for user_id in stale:
+        await cleanup_client(user_id)
+    if stale:
+        logger.info(f"Evicted {len(stale)} idle Telegram clients ({len(_active_clients)} active)")
+
+async def start_client_eviction(interval: float = 60):
+    """
+    Periodically evict idle clients, and expired cached photos every
+    PHOTO_PRUNE_INTERVAL seconds. Runs until cancelled.
+    """
+    last_prune = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await evict_stale_clients()
+        except Exception as e:
+            logger.error(f"Error evicting idle Telegram clients: {e}")
+        
+        if time.monotonic() - last_prune < PHOTO_PRUNE_INTERVAL:
+            continue
+        last_prune = time.monotonic()
+        try:
+            removed = await asyncio.to_thread(prune_photo_cache)
+            if removed:
+                logger.info(f"Pruned {removed} expired cached photos")
+        except Exception as e:
+            logger.error(f"Error pruning photo cache: {e}")
 
 # Global bot client instance
 _bot_client: Optional[TelegramClient] = None
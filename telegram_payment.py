@@ -5,47 +5,51 @@ Handles payment processing using Telegram Stars (XTR) currency.
 Implements invoice generation, payment webhooks, and subscription upgrades.
 """
 
+import asyncio
 import logging
 import hmac
 import hashlib
-import json
+import time
 from typing import Optional, Dict, Any
 from datetime import datetime
 import httpx
-from pydantic import BaseModel
+import orjson
+from cachetools import TTLCache
 
 import config
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum age (seconds) of a signed webhook timestamp before it is rejected
+WEBHOOK_TIMESTAMP_TOLERANCE = 300
 
-# Payment Models
-class PaymentInvoice(BaseModel):
-    """Invoice details for Telegram Stars payment"""
-    title: str
-    description: str
-    payload: str
-    currency: str = "XTR"  # Telegram Stars
-    prices: list[Dict[str, int]]  # [{"label": "Premium", "amount": 100}]
+# Bot API send limits: ~30 requests/s per bot, ~1 message/s per chat
+GLOBAL_RATE_PER_SEC = 28
+CHAT_RATE_PER_SEC = 1
 
 
-class PreCheckoutQuery(BaseModel):
-    """Pre-checkout query from Telegram"""
-    id: str
-    from_user: Dict[str, Any]
-    currency: str
-    total_amount: int
-    invoice_payload: str
-
-
-class SuccessfulPayment(BaseModel):
-    """Successful payment notification"""
-    currency: str
-    total_amount: int
-    invoice_payload: str
-    telegram_payment_charge_id: str
-    provider_payment_charge_id: Optional[str] = None
+class AsyncTokenBucket:
+    """Token bucket allowing `rate` acquisitions per `per` seconds; callers wait when empty"""
+    
+    def __init__(self, rate: float, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
 
 
 class TelegramPaymentService:
@@ -59,6 +63,74 @@ class TelegramPaymentService:
         # Payment configuration
         self.premium_price_stars = int(getattr(config, 'PREMIUM_PRICE_STARS', 150))
         
+        # Invoice fields that never change between calls
+        self._invoice_template = {
+            "currency": "XTR",  # Telegram Stars
+            # provider_token must be omitted for XTR
+            # "provider_token": "", 
+            # Optional parameters
+            "start_parameter": "premium_upgrade",
+            "photo_width": 512,
+            "photo_height": 512,
+        }
+        
+        # Shared HTTP client (keep-alive + HTTP/2), created lazily on first use
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # Client-side throttling so bursts queue instead of hitting 429s.
+        # Idle per-chat buckets are full anyway, so expiring them is harmless.
+        self._global_bucket = AsyncTokenBucket(GLOBAL_RATE_PER_SEC)
+        self._chat_buckets: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared Bot API client, (re)creating it if needed."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.api_base,
+                http2=True,
+                headers={"Content-Type": "application/json"},
+                timeout=httpx.Timeout(10.0),
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+            )
+        return self._client
+    
+    def _chat_bucket(self, chat_id: int) -> AsyncTokenBucket:
+        """Get or create the per-chat rate limiter"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = AsyncTokenBucket(CHAT_RATE_PER_SEC)
+        return bucket
+    
+    async def _post(self, method: str, data: Dict[str, Any], chat_id: Optional[int] = None) -> httpx.Response:
+        """
+        POST a Bot API method through the rate limiters
+        
+        On HTTP 429 waits for the server-provided retry_after and retries once.
+        """
+        client = self._get_client()
+        content = orjson.dumps(data)
+        for attempt in range(2):
+            await self._global_bucket.acquire()
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            
+            response = await client.post(f"/{method}", content=content)
+            if response.status_code != 429 or attempt:
+                return response
+            
+            try:
+                retry_after = orjson.loads(response.content).get("parameters", {}).get("retry_after", 1)
+            except orjson.JSONDecodeError:
+                retry_after = 1
+            logger.warning(f"Telegram rate limit on {method}, retrying in {retry_after}s")
+            await asyncio.sleep(retry_after)
+    
+    async def aclose(self):
+        """Close the shared HTTP client (called on application shutdown)."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        
     def verify_webhook_signature(self, request_data: str, signature: str) -> bool:
         """
         Verify webhook request is from Telegram using secret token
@@ -74,7 +146,40 @@ class TelegramPaymentService:
             logger.warning("Webhook secret not configured, skipping verification")
             return True
             
-        return signature == self.webhook_secret
+        return hmac.compare_digest(
+            signature.encode("utf-8"),
+            self.webhook_secret.encode("utf-8")
+        )
+    
+    def verify_hmac(self, raw_body: bytes, header_sig: str, timestamp: Optional[str] = None) -> bool:
+        """
+        Verify an HMAC-SHA256 signature of the raw request body
+        
+        Args:
+            raw_body: Raw request body as bytes
+            header_sig: Hex digest from the signature header (optionally "sha256=" prefixed)
+            timestamp: Unix timestamp header value, if the sender provides one
+            
+        Returns:
+            bool: True if signature is valid (and timestamp within tolerance)
+        """
+        if not self.webhook_secret:
+            logger.warning("Webhook secret not configured, skipping verification")
+            return True
+        
+        if timestamp is not None:
+            try:
+                if abs(time.time() - int(timestamp)) > WEBHOOK_TIMESTAMP_TOLERANCE:
+                    logger.warning("Webhook timestamp outside tolerance")
+                    return False
+            except ValueError:
+                return False
+        
+        expected = hmac.new(self.webhook_secret.encode("utf-8"), raw_body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(
+            expected.encode("utf-8"),
+            header_sig.removeprefix("sha256=").encode("utf-8")
+        )
     
     async def create_invoice(
         self,
@@ -102,45 +207,36 @@ class TelegramPaymentService:
         Reference:
             https://core.telegram.org/bots/api#sendinvoice
         """
-        url = f"{self.api_base}/sendInvoice"
-        
-        # Prepare invoice data
+        # Prepare invoice data (static fields come from the template)
         invoice_data = {
+            **self._invoice_template,
             "chat_id": chat_id,
             "title": title,
             "description": description,
             "payload": payload,
-            "currency": "XTR",  # Telegram Stars
-            "prices": json.dumps([{
+            "prices": [{
                 "label": "Premium Subscription",
                 "amount": price
-            }]),
-            # provider_token must be omitted for XTR
-            # "provider_token": "", 
-            # Optional parameters
-            "start_parameter": "premium_upgrade",
+            }],
             "photo_url": photo_url,
-            "photo_width": 512,
-            "photo_height": 512,
         }
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=invoice_data)
+            response = await self._post("sendInvoice", invoice_data, chat_id=chat_id)
+            
+            if response.status_code != 200:
+                logger.error(f"Telegram API Error: {response.text}")
                 
-                if response.status_code != 200:
-                    logger.error(f"Telegram API Error: {response.text}")
-                    
-                response.raise_for_status()
-                result = response.json()
+            response.raise_for_status()
+            result = orjson.loads(response.content)
+            
+            if result.get("ok"):
+                logger.info(f"Invoice sent successfully to chat {chat_id}")
+                return result
+            else:
+                logger.error(f"Failed to send invoice: {result}")
+                raise Exception(f"Telegram API error: {result.get('description')}")
                 
-                if result.get("ok"):
-                    logger.info(f"Invoice sent successfully to chat {chat_id}")
-                    return result
-                else:
-                    logger.error(f"Failed to send invoice: {result}")
-                    raise Exception(f"Telegram API error: {result.get('description')}")
-                    
         except httpx.HTTPError as e:
             logger.error(f"HTTP error sending invoice: {e}")
             raise
@@ -150,39 +246,34 @@ class TelegramPaymentService:
     
     async def send_message(self, chat_id: int, text: str, parse_mode: str = None) -> bool:
         """Send a text message to a chat."""
-        url = f"{self.api_base}/sendMessage"
         data = {"chat_id": chat_id, "text": text}
         if parse_mode:
             data["parse_mode"] = parse_mode
         
         try:
-            async with httpx.AsyncClient() as client:
-                await client.post(url, json=data)
-                return True
+            await self._post("sendMessage", data, chat_id=chat_id)
+            return True
         except Exception as e:
             logger.error(f"Error sending message: {e}")
             return False
 
     async def refund_payment(self, user_id: int, charge_id: str) -> bool:
         """Refund a Telegram Stars payment."""
-        url = f"{self.api_base}/refundStarPayment"
-        
         data = {
             "user_id": user_id,
             "telegram_payment_charge_id": charge_id
         }
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=data)
-                result = response.json()
-                
-                if not result.get("ok"):
-                    logger.error(f"Refund failed: {result}")
-                    return False
-                    
-                return True
+            response = await self._post("refundStarPayment", data)
+            result = orjson.loads(response.content)
+            
+            if not result.get("ok"):
+                logger.error(f"Refund failed: {result}")
+                return False
                 
+            return True
+            
         except Exception as e:
             logger.error(f"Error processing refund: {e}")
             return False
@@ -207,8 +298,6 @@ class TelegramPaymentService:
         Reference:
             https://core.telegram.org/bots/api#answerprecheckoutquery
         """
-        url = f"{self.api_base}/answerPreCheckoutQuery"
-        
         data = {
             "pre_checkout_query_id": pre_checkout_query_id,
             "ok": ok
@@ -218,18 +307,17 @@ class TelegramPaymentService:
             data["error_message"] = error_message
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=data)
-                response.raise_for_status()
-                result = response.json()
+            response = await self._post("answerPreCheckoutQuery", data)
+            response.raise_for_status()
+            result = orjson.loads(response.content)
+            
+            if result.get("ok"):
+                logger.info(f"Pre-checkout query answered: {ok}")
+                return result
+            else:
+                logger.error(f"Failed to answer pre-checkout: {result}")
+                raise Exception(f"Telegram API error: {result.get('description')}")
                 
-                if result.get("ok"):
-                    logger.info(f"Pre-checkout query answered: {ok}")
-                    return result
-                else:
-                    logger.error(f"Failed to answer pre-checkout: {result}")
-                    raise Exception(f"Telegram API error: {result.get('description')}")
-                    
         except Exception as e:
             logger.error(f"Error answering pre-checkout query: {e}")
             raise
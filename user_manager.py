@@ -1,87 +1,273 @@
+import asyncio
 import logging
+import math
+import threading
 from datetime import datetime, timedelta
-from typing import Optional
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from cachetools import TTLCache
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from database import SessionLocal
 from sql_models import User
 from models import SubscriptionStatus, SubscriptionTier
+from redis_client import RedisCache
 import random
 import string
 
 logger = logging.getLogger(__name__)
 
+# Shared (Redis) cache lifetime for telegram_id -> phone and referral info
+REDIS_CACHE_TTL = 300
+
+# Minimum age of user_sessions.last_used_at before get_session rewrites it
+SESSION_TOUCH_INTERVAL = timedelta(seconds=60)
+
+_REFERRAL_CHARS = string.ascii_uppercase + string.digits
+
+# Tiers whose access ends at expiry_date
+_EXPIRING_TIERS = frozenset({
+    SubscriptionTier.TRIAL,
+    SubscriptionTier.PREMIUM,
+    SubscriptionTier.PREMIUM_BASIC,
+    SubscriptionTier.PREMIUM_ADVANCED,
+})
+
+
+def _dialect_insert(db: Session):
+    """INSERT construct with ON CONFLICT support for the bound backend (Postgres or local SQLite)."""
+    return pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+
+
+def _scheduled_downgrade_cost(user) -> dict:
+    return {"amount": 0, "currency": "EUR", "description": "Downgrade (no cost, scheduled)"}
+
+
+def _basic_to_advanced_cost(user) -> dict:
+    # Check if Yearly or Monthly
+    # We don't strictly track "Yearly" vs "Monthly" in the DB, just expiry.
+    # But we can infer or maybe we should have stored it. 
+    # For now, let's infer from remaining duration? 
+    # Or better, let's look at the requirement: "upgrade from basic to advanced per month should not be calculated by the number of day, it should just be set to 1 euro"
+    
+    now = datetime.utcnow()
+    if not user.expiry_date or user.expiry_date <= now:
+        # Expired or Free -> Full price (handled by frontend usually, but here we can return full price)
+        # But this method is specifically for "Upgrade", implying active sub.
+        return {"amount": 3.00, "currency": "EUR", "description": "Full Price (Expired)"}
+
+    remaining = user.expiry_date - now
+    remaining_days = remaining.days
+    
+    # Heuristic: If remaining > 35 days, assume Yearly.
+    # User request: "payment for 5 months would be 5/12 * €10"
+    # So if they have ~5 months left, it's a yearly plan.
+    
+    # Round up to nearest month
+    remaining_months = math.ceil(remaining_days / 30.0)
+    if remaining_months < 1: remaining_months = 1
+    
+    cost = remaining_months * 1.00 # 1 EUR per month difference
+    
+    return {
+        "amount": cost, 
+        "currency": "EUR", 
+        "description": f"Upgrade to Advanced ({remaining_months} Months Upgraded)",
+        "is_prorated": True,
+        "upgrade_type": "monthly_prorated"
+    }
+
+
+# (current_tier, target_tier) -> cost handler taking the user's (tier, expiry_date) row
+_UPGRADE_TABLE = {
+    (SubscriptionTier.PREMIUM_ADVANCED, SubscriptionTier.PREMIUM_BASIC): _scheduled_downgrade_cost,
+    (SubscriptionTier.PREMIUM_BASIC, SubscriptionTier.PREMIUM_ADVANCED): _basic_to_advanced_cost,
+}
+
+
 class UserManager:
     def __init__(self):
-        pass
+        # telegram_id -> phone for the webhook hot path. Only hits are cached,
+        # so a newly linked account is found on the next lookup. The TTL matches
+        # Redis so relinks made by other instances are picked up.
+        self._phone_by_tg = TTLCache(maxsize=4096, ttl=REDIS_CACHE_TTL)
+        # phone -> (SubscriptionStatus, flips_at). Tier only changes through the
+        # methods below, which invalidate inline; the TTL bounds staleness otherwise.
+        self._status_cache = TTLCache(maxsize=10_000, ttl=60)
+        # (phone, instance_id) -> session string; invalidated by save/delete_session
+        self._session_cache = TTLCache(maxsize=10_000, ttl=30)
+        self._cache_lock = threading.RLock()
 
     def get_db(self):
         return SessionLocal()
 
-    def get_subscription_status(self, phone: str, return_is_new: bool = False):
-        """Get subscription status for a user. Optionally returns tuple (status, is_new_user)."""
+    @contextmanager
+    def session_scope(self, db: Optional[Session] = None):
+        """
+        Yield a DB session. Reuses the caller's (request-scoped) session when
+        given, otherwise opens a fresh one and closes it on exit. A shared
+        session is rolled back on error so the caller can keep using it.
+        """
+        if db is not None:
+            try:
+                yield db
+            except Exception:
+                db.rollback()
+                raise
+            return
         db = self.get_db()
         try:
-            user = db.query(User).filter(User.phone == phone).first()
+            yield db
+        finally:
+            db.close()
+
+    def _invalidate_status(self, *phones: str):
+        with self._cache_lock:
+            for phone in phones:
+                self._status_cache.pop(phone, None)
+
+    def _cached_status(self, phone: str) -> Optional[SubscriptionStatus]:
+        with self._cache_lock:
+            cached = self._status_cache.get(phone)
+        if cached is not None:
+            status, flips_at = cached
+            # Recompute once a cached subscription reaches its expiry date
+            if flips_at is None or datetime.utcnow() <= flips_at:
+                return status
+        return None
+
+    def _build_status(self, phone: str, user) -> SubscriptionStatus:
+        """Build (and cache) the status from a User or a row with the status columns."""
+        is_expired = False
+        trial_available = user.trial_start_date is None
+        
+        # Tier first: FREE users (the common case) never touch the expiry date
+        if user.tier in _EXPIRING_TIERS and user.expiry_date:
+            is_expired = datetime.utcnow() > user.expiry_date
+        
+        # Map legacy premium to advanced
+        tier = user.tier
+        if tier == SubscriptionTier.PREMIUM:
+            tier = SubscriptionTier.PREMIUM_ADVANCED
+
+        status = SubscriptionStatus(
+            tier=tier,
+            trial_start_date=user.trial_start_date.isoformat() if user.trial_start_date else None,
+            expiry_date=user.expiry_date.isoformat() if user.expiry_date else None,
+            is_expired=is_expired,
+            trial_available=trial_available,
+            telegram_id=user.telegram_id
+        )
+        flips_at = user.expiry_date if user.expiry_date and not is_expired else None
+        with self._cache_lock:
+            self._status_cache[phone] = (status, flips_at)
+        return status
+
+    def get_subscription_status(self, phone: str, return_is_new: bool = False, db: Optional[Session] = None):
+        """Get subscription status for a user. Optionally returns tuple (status, is_new_user)."""
+        status = self._cached_status(phone)
+        if status is not None:
+            return (status, False) if return_is_new else status
+        
+        # Only the columns needed for the status (no full ORM hydration)
+        status_columns = (User.tier, User.trial_start_date, User.expiry_date, User.telegram_id)
+        with self.session_scope(db) as db:
+            user = db.execute(select(*status_columns).where(User.phone == phone)).first()
             is_new_user = False
             
             if not user:
-                # Create new user
+                # Create new user with a single INSERT ... RETURNING. ON CONFLICT DO NOTHING
+                # absorbs a concurrent first request for the same phone as well as a clash
+                # with an existing referral code (retried with a fresh code).
                 logger.info(f"User {phone} not found in DB. Creating new user.")
-                referral_code = self.generate_referral_code()
-                user = User(phone=phone, tier=SubscriptionTier.FREE, referral_code=referral_code)
-                db.add(user)
-                db.commit()
-                db.refresh(user)
-                is_new_user = True
+                insert = _dialect_insert(db)
+                for _ in range(3):
+                    user = db.execute(
+                        insert(User)
+                        .values(phone=phone, tier=SubscriptionTier.FREE, referral_code=self.generate_referral_code())
+                        .on_conflict_do_nothing()
+                        .returning(*status_columns)
+                    ).first()
+                    db.commit()
+                    if user:
+                        is_new_user = True
+                        break
+                    user = db.execute(select(*status_columns).where(User.phone == phone)).first()
+                    if user:
+                        break
+                else:
+                    raise Exception(f"Could not create user {phone}")
             else:
                 logger.info(f"Found existing user {phone} in DB. Tier: {user.tier}, Expiry: {user.expiry_date}")
             
-            is_expired = False
-            trial_available = user.trial_start_date is None
-            
-            if user.expiry_date and user.tier in [SubscriptionTier.TRIAL, SubscriptionTier.PREMIUM, SubscriptionTier.PREMIUM_BASIC, SubscriptionTier.PREMIUM_ADVANCED]:
-                if datetime.utcnow() > user.expiry_date:
-                    is_expired = True
-            
-            # Map legacy premium to advanced
-            tier = user.tier
-            if tier == SubscriptionTier.PREMIUM:
-                tier = SubscriptionTier.PREMIUM_ADVANCED
-
-            status = SubscriptionStatus(
-                tier=tier,
-                trial_start_date=user.trial_start_date.isoformat() if user.trial_start_date else None,
-                expiry_date=user.expiry_date.isoformat() if user.expiry_date else None,
-                is_expired=is_expired,
-                trial_available=trial_available,
-                telegram_id=user.telegram_id
-            )
+            status = self._build_status(phone, user)
             
             if return_is_new:
                 return status, is_new_user
             return status
-        finally:
-            db.close()
 
-    def update_telegram_id(self, phone: str, telegram_id: int):
+    async def aget_subscription_status(self, phone: str, return_is_new: bool = False, db: Optional[Session] = None):
+        """
+        Async variant of get_subscription_status for event-loop callers. Cache hits
+        return inline; misses run the sync DB path in a worker thread.
+        """
+        status = self._cached_status(phone)
+        if status is not None:
+            return (status, False) if return_is_new else status
+        return await asyncio.to_thread(self.get_subscription_status, phone, return_is_new, db)
+
+    async def aget_subscription_statuses(self, phones: List[str]) -> Dict[str, SubscriptionStatus]:
+        """Async variant of get_subscription_statuses; the DB work runs in a worker thread."""
+        return await asyncio.to_thread(self.get_subscription_statuses, phones)
+
+    def get_subscription_statuses(self, phones: List[str], db: Optional[Session] = None) -> Dict[str, SubscriptionStatus]:
+        """Get subscription statuses for many users with a single query for the uncached ones."""
+        statuses = {}
+        missing = []
+        for phone in phones:
+            status = self._cached_status(phone)
+            if status is not None:
+                statuses[phone] = status
+            else:
+                missing.append(phone)
+        if not missing:
+            return statuses
+        
+        with self.session_scope(db) as db:
+            rows = db.execute(
+                select(User.phone, User.tier, User.trial_start_date, User.expiry_date, User.telegram_id)
+                .where(User.phone.in_(missing))
+            ).all()
+            for row in rows:
+                statuses[row.phone] = self._build_status(row.phone, row)
+            
+            # Unknown phones go through the single path, which creates the user
+            for phone in missing:
+                if phone not in statuses:
+                    statuses[phone] = self.get_subscription_status(phone, db=db)
+        return statuses
+
+    def update_telegram_id(self, phone: str, telegram_id: int, db: Optional[Session] = None):
         """Update the Telegram ID for a user."""
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.phone == phone).first()
-            if user:
-                user.telegram_id = telegram_id
-                db.commit()
-                logger.info(f"Updated Telegram ID for {phone} to {telegram_id}")
-        except Exception as e:
-            logger.error(f"Error updating Telegram ID: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        with self.session_scope(db) as db:
+            try:
+                user = db.query(User).filter(User.phone == phone).first()
+                if user:
+                    old_telegram_id = user.telegram_id
+                    user.telegram_id = telegram_id
+                    db.commit()
+                    self._invalidate_telegram_id(old_telegram_id, telegram_id)
+                    self._invalidate_status(phone)
+                    logger.info(f"Updated Telegram ID for {phone} to {telegram_id}")
+            except Exception as e:
+                logger.error(f"Error updating Telegram ID: {e}")
+                db.rollback()
 
-    def start_trial(self, phone: str):
+    def start_trial(self, phone: str, db: Optional[Session] = None):
         """Initialize a 3-day trial for a user."""
-        db = self.get_db()
-        try:
+        with self.session_scope(db) as db:
             user = db.query(User).filter(User.phone == phone).first()
             if not user:
                 raise Exception("User not found")
@@ -90,290 +276,305 @@ class UserManager:
                 raise Exception("Trial already activated for this account")
             
             user.tier = SubscriptionTier.TRIAL
-            user.trial_start_date = datetime.utcnow()
-            user.expiry_date = datetime.utcnow() + timedelta(days=3)
+            now = datetime.utcnow()
+            user.trial_start_date = now
+            user.expiry_date = now + timedelta(days=3)
             
             db.commit()
+            self._invalidate_status(phone)
             logger.info(f"Started trial for user {phone}")
-        finally:
-            db.close()
 
-    def link_telegram_id(self, phone: str, telegram_id: int):
+    def link_telegram_id(self, phone: str, telegram_id: int, db: Optional[Session] = None):
         """Link a Telegram ID to a user's phone number."""
-        db = self.get_db()
-        try:
+        with self.session_scope(db) as db:
             user = db.query(User).filter(User.phone == phone).first()
             if user:
+                old_telegram_id = user.telegram_id
                 user.telegram_id = telegram_id
                 db.commit()
+                self._invalidate_telegram_id(old_telegram_id, telegram_id)
+                self._invalidate_status(phone)
                 logger.info(f"Linked Telegram ID {telegram_id} to user {phone}")
-        finally:
-            db.close()
 
-    def get_user_by_phone(self, phone: str) -> Optional[User]:
+    def get_user_by_phone(self, phone: str, db: Optional[Session] = None) -> Optional[User]:
         """Get user by phone number."""
-        db = self.get_db()
-        try:
-            return db.query(User).filter(User.phone == phone).first()
-        finally:
-            db.close()
+        with self.session_scope(db) as db:
+            return db.execute(select(User).where(User.phone == phone)).scalars().first()
 
-    def save_session(self, phone: str, session_string: str, instance_id: str = "default"):
+    def get_users_by_phones(self, phones: List[str], db: Optional[Session] = None) -> Dict[str, User]:
+        """Get several users with one query, keyed by phone. Unknown phones are omitted."""
+        if not phones:
+            return {}
+        with self.session_scope(db) as db:
+            return {u.phone: u for u in db.execute(select(User).where(User.phone.in_(phones))).scalars()}
+
+    def save_session(self, phone: str, session_string: str, instance_id: str = "default", db: Optional[Session] = None):
         """Save Telegram session string for a user."""
-        db = self.get_db()
-        try:
-            # Upsert session
+        with self.session_scope(db) as db:
+            # Upsert session in one statement (unique index on user_phone, instance_id)
             from sql_models import UserSession
-            session = db.query(UserSession).filter(
-                UserSession.user_phone == phone,
-                UserSession.instance_id == instance_id
-            ).first()
-            
-            if session:
-                session.session_string = session_string
-                session.last_used_at = datetime.utcnow()
-            else:
-                session = UserSession(
-                    user_phone=phone,
-                    session_string=session_string,
-                    instance_id=instance_id
-                )
-                db.add(session)
-            
+            insert = _dialect_insert(db)
+            now = datetime.utcnow()
+            stmt = insert(UserSession).values(
+                user_phone=phone,
+                session_string=session_string,
+                instance_id=instance_id,
+                last_used_at=now
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["user_phone", "instance_id"],
+                set_={"session_string": stmt.excluded.session_string, "last_used_at": now}
+            )
+            db.execute(stmt)
             db.commit()
+            with self._cache_lock:
+                self._session_cache[(phone, instance_id)] = session_string
             logger.info(f"Saved session string for user {phone} (instance: {instance_id})")
-        finally:
-            db.close()
 
-    def get_session(self, phone: str, instance_id: str = "default") -> Optional[str]:
+    def get_session(self, phone: str, instance_id: str = "default", db: Optional[Session] = None) -> Optional[str]:
         """Get Telegram session string for a user."""
-        db = self.get_db()
-        try:
+        key = (phone, instance_id)
+        with self._cache_lock:
+            session_string = self._session_cache.get(key)
+        if session_string is not None:
+            return session_string
+        
+        session_string = self._load_session(phone, instance_id, db=db)
+        if session_string is not None:
+            with self._cache_lock:
+                self._session_cache[key] = session_string
+        return session_string
+
+    def _load_session(self, phone: str, instance_id: str, db: Optional[Session] = None) -> Optional[str]:
+        with self.session_scope(db) as db:
             from sql_models import UserSession
-            session = db.query(UserSession).filter(
-                UserSession.user_phone == phone,
-                UserSession.instance_id == instance_id
+            session = db.execute(
+                select(UserSession.session_string, UserSession.last_used_at).where(
+                    UserSession.user_phone == phone,
+                    UserSession.instance_id == instance_id
+                )
             ).first()
             
             if session:
-                # Update last used
-                session.last_used_at = datetime.utcnow()
-                db.commit()
+                # Update last used, at most once per interval (this is read on every client lookup)
+                now = datetime.utcnow()
+                if session.last_used_at is None or now - session.last_used_at > SESSION_TOUCH_INTERVAL:
+                    db.execute(
+                        update(UserSession).where(
+                            UserSession.user_phone == phone,
+                            UserSession.instance_id == instance_id
+                        ).values(last_used_at=now)
+                    )
+                    db.commit()
                 return session.session_string
             
             # Fallback to legacy session_string in users table if not found in default instance
             if instance_id == "default":
-                user = db.query(User).filter(User.phone == phone).first()
-                if user and user.session_string:
+                legacy_session = db.execute(
+                    select(User.session_string).where(User.phone == phone)
+                ).scalar_one_or_none()
+                if legacy_session:
                     # Migrate on the fly? No, let migration script handle it.
                     # Just return it for now to be safe
-                    return user.session_string
+                    return legacy_session
                     
             return None
-        finally:
-            db.close()
 
-    def delete_session(self, phone: str, instance_id: str = "default"):
+    def delete_session(self, phone: str, instance_id: str = "default", db: Optional[Session] = None):
         """Delete a session."""
-        db = self.get_db()
-        try:
+        with self.session_scope(db) as db:
             from sql_models import UserSession
             db.query(UserSession).filter(
                 UserSession.user_phone == phone,
                 UserSession.instance_id == instance_id
             ).delete()
             db.commit()
+            with self._cache_lock:
+                self._session_cache.pop((phone, instance_id), None)
             logger.info(f"Deleted session for user {phone} (instance: {instance_id})")
-        finally:
-            db.close()
 
-    def get_phone_by_telegram_id(self, telegram_id: int) -> Optional[str]:
+    def _invalidate_telegram_id(self, *telegram_ids: Optional[int]):
+        # The local cache can't be searched by phone, so drop it whole
+        with self._cache_lock:
+            self._phone_by_tg.clear()
+        RedisCache.delete(*(f"tg_phone:{tg_id}" for tg_id in telegram_ids if tg_id is not None))
+
+    def _cached_phone(self, telegram_id: int) -> Optional[str]:
+        with self._cache_lock:
+            return self._phone_by_tg.get(telegram_id)
+
+    def _cache_phone(self, telegram_id: int, phone: str):
+        with self._cache_lock:
+            self._phone_by_tg[telegram_id] = phone
+
+    def get_phone_by_telegram_id(self, telegram_id: int, db: Optional[Session] = None) -> Optional[str]:
         """Find phone number associated with a Telegram ID."""
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.telegram_id == telegram_id).first()
-            return user.phone if user else None
-        finally:
-            db.close()
+        phone = self._cached_phone(telegram_id)
+        if phone is not None:
+            return phone
+        
+        key = f"tg_phone:{telegram_id}"
+        phone = RedisCache.get(key)
+        if phone is not None:
+            self._cache_phone(telegram_id, phone)
+            return phone
+        
+        with self.session_scope(db) as db:
+            phone = db.execute(
+                select(User.phone).where(User.telegram_id == telegram_id)
+            ).scalar_one_or_none()
+            if phone is not None:
+                self._cache_phone(telegram_id, phone)
+                RedisCache.set(key, phone, REDIS_CACHE_TTL)
+            return phone
 
-    def upgrade_to_premium(self, phone: str, payment_method: str = None, tier: str = SubscriptionTier.PREMIUM_ADVANCED, duration_days: int = 30, stripe_customer_id: str = None, stripe_subscription_id: str = None):
-        """Upgrade user to premium."""
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.phone == phone).first()
-            if user:
-                user.tier = tier
-                # Extend expiry date
-                now = datetime.utcnow()
-                if user.expiry_date and user.expiry_date > now:
-                    user.expiry_date += timedelta(days=duration_days)
-                else:
-                    user.expiry_date = now + timedelta(days=duration_days)
-                
-                if payment_method:
-                    user.payment_method = payment_method
-                
-                if stripe_customer_id:
-                    user.stripe_customer_id = stripe_customer_id
-                if stripe_subscription_id:
-                    user.stripe_subscription_id = stripe_subscription_id
+    async def aget_phone_by_telegram_id(self, telegram_id: int) -> Optional[str]:
+        """
+        Async variant of get_phone_by_telegram_id. In-process hits return inline;
+        Redis and DB lookups run in a worker thread.
+        """
+        phone = self._cached_phone(telegram_id)
+        if phone is not None:
+            return phone
+        return await asyncio.to_thread(self.get_phone_by_telegram_id, telegram_id)
 
-                db.commit()
-                logger.info(f"Upgraded user {phone} to premium via {payment_method or 'unknown'} for {duration_days} days. New expiry: {user.expiry_date}")
-                # Double check persistence
-                db.refresh(user)
-                logger.info(f"VERIFICATION - User {phone} expiry after commit/refresh: {user.expiry_date}")
-        finally:
-            db.close()
+    def upgrade_to_premium(self, phone: str, payment_method: str = None, tier: str = SubscriptionTier.PREMIUM_ADVANCED, duration_days: int = 30, stripe_customer_id: str = None, stripe_subscription_id: str = None, db: Optional[Session] = None):
+        """Upgrade user to premium."""
+        with self.session_scope(db) as db:
+            # FOR UPDATE holds the row until commit, so concurrent upgrades (e.g. a
+            # webhook retry racing a checkout) extend the expiry one after another
+            row = db.execute(
+                select(User.expiry_date).where(User.phone == phone).with_for_update()
+            ).first()
+            if not row:
+                return
+            
+            # Extend expiry date
+            now = datetime.utcnow()
+            if row.expiry_date and row.expiry_date > now:
+                expiry_date = row.expiry_date + timedelta(days=duration_days)
+            else:
+                expiry_date = now + timedelta(days=duration_days)
+            
+            values = {"tier": tier, "expiry_date": expiry_date}
+            if payment_method:
+                values["payment_method"] = payment_method
+            if stripe_customer_id:
+                values["stripe_customer_id"] = stripe_customer_id
+            if stripe_subscription_id:
+                values["stripe_subscription_id"] = stripe_subscription_id
+            
+            # RETURNING gives back the persisted expiry, no refresh needed to verify it
+            saved_expiry = db.execute(
+                update(User).where(User.phone == phone).values(**values).returning(User.expiry_date)
+            ).scalar_one()
+            db.commit()
+            self._invalidate_status(phone)
+            logger.info(f"Upgraded user {phone} to premium via {payment_method or 'unknown'} for {duration_days} days. New expiry: {saved_expiry}")
 
-    def downgrade_to_free(self, phone: str, feed_config_manager=None):
+    def downgrade_to_free(self, phone: str, feed_config_manager=None, db: Optional[Session] = None):
         """Downgrade user to free tier and handle feed restrictions."""
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.phone == phone).first()
-            if user:
-                user.tier = SubscriptionTier.FREE
-                user.expiry_date = None
-                db.commit()
+        with self.session_scope(db) as db:
+            result = db.execute(
+                update(User).where(User.phone == phone).values(tier=SubscriptionTier.FREE, expiry_date=None)
+            )
+            db.commit()
+            if result.rowcount:
+                self._invalidate_status(phone)
                 logger.info(f"Downgraded user {phone} to free")
                 
-                # Handle feed restrictions
+                # Handle feed restrictions. Callers that don't need the feeds settled
+                # before responding schedule reconcile_feeds_after_downgrade themselves.
                 if feed_config_manager:
-                    # We can pass the same db session if we want, but for now let's let manager handle it
-                    # Or better, we should probably do this logic here since we have the DB
-                    pass 
-                    # Note: The original logic called feed_config_manager. 
-                    # We will rely on the caller to handle feed restrictions or implement it here.
-                    # For now, I'll replicate the logic using feed_config_manager which will be updated to use DB.
-                    
-                    try:
-                        feeds = feed_config_manager.get_user_feeds(phone)
-                        if not feeds:
-                            return
-                        
-                        def has_filters(feed):
-                            if feed.filters:
-                                f = feed.filters
-                                if (f.keywords_include or f.keywords_exclude or 
-                                    f.has_image is not None or f.has_video is not None or 
-                                    f.max_messages_per_hour is not None or f.max_messages_per_day is not None):
-                                    return True
-                            if feed.source_filters and len(feed.source_filters) > 0:
-                                return True
-                            return False
-                        
-                        # Deactivate all feeds with filters
-                        for feed in feeds:
-                            if feed.active and has_filters(feed):
-                                feed_config_manager.update_feed(phone, feed.id, {
-                                    "active": False,
-                                    "error": "INACTIVE - Upgrade to Premium to use filters"
-                                })
-                        
-                        # Reload feeds
-                        feeds = feed_config_manager.get_user_feeds(phone)
-                        active_count = sum(1 for f in feeds if f.active)
-                        
-                        if active_count == 0:
-                            for feed in feeds:
-                                if not has_filters(feed):
-                                    feed_config_manager.update_feed(phone, feed.id, {
-                                        "active": True,
-                                        "error": None
-                                    })
-                                    break
-                            else:
-                                if feeds:
-                                    feed_config_manager.update_feed(phone, feeds[0].id, {
-                                        "active": False,
-                                        "error": "INACTIVE - Remove filters or upgrade to Premium"
-                                    })
-                        elif active_count > 1:
-                            first_active_found = False
-                            for feed in feeds:
-                                if feed.active:
-                                    if not first_active_found:
-                                        first_active_found = True
-                                    else:
-                                        feed_config_manager.update_feed(phone, feed.id, {"active": False})
-
-                    except Exception as e:
-                        logger.error(f"Error handling feeds during downgrade for {phone}: {e}")
-        finally:
-            db.close()
+                    self.reconcile_feeds_after_downgrade(phone, feed_config_manager)
+
+    def reconcile_feeds_after_downgrade(self, phone: str, feed_config_manager):
+        """Apply free-tier feed restrictions: no filtered feeds and at most one active feed."""
+        try:
+            feeds = feed_config_manager.get_user_feeds(phone)
+            if not feeds:
+                return
+
+            def has_filters(feed):
+                if feed.filters:
+                    f = feed.filters
+                    if (f.keywords_include or f.keywords_exclude or 
+                        f.has_image is not None or f.has_video is not None or 
+                        f.max_messages_per_hour is not None or f.max_messages_per_day is not None):
+                        return True
+                if feed.source_filters and len(feed.source_filters) > 0:
+                    return True
+                return False
+
+            # Deactivate all feeds with filters. The in-memory copies are
+            # updated too, so the pass below works without a reload.
+            filtered = [has_filters(f) for f in feeds]
+            ops = []
+            for feed, is_filtered in zip(feeds, filtered):
+                if feed.active and is_filtered:
+                    feed.active = False
+                    feed.error = "INACTIVE - Upgrade to Premium to use filters"
+                    ops.append((feed.id, {
+                        "active": False,
+                        "error": feed.error
+                    }))
+
+            active = [f for f in feeds if f.active]
 
-    def calculate_upgrade_cost(self, phone: str, target_tier: str) -> dict:
+            if not active:
+                unfiltered = next((f for f, is_filtered in zip(feeds, filtered) if not is_filtered), None)
+                if unfiltered:
+                    ops.append((unfiltered.id, {
+                        "active": True,
+                        "error": None
+                    }))
+                else:
+                    ops.append((feeds[0].id, {
+                        "active": False,
+                        "error": "INACTIVE - Remove filters or upgrade to Premium"
+                    }))
+            else:
+                # Free tier keeps only the first active feed
+                ops.extend((f.id, {"active": False}) for f in active[1:])
+            feed_config_manager.update_feeds_bulk(phone, ops)
+
+        except Exception as e:
+            logger.error(f"Error handling feeds during downgrade for {phone}: {e}")
+
+    def calculate_upgrade_cost(self, phone: str, target_tier: str, db: Optional[Session] = None) -> dict:
         """
         Calculate the cost to upgrade from current tier to target tier.
         Returns a dict with amount, currency, and description.
         """
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.phone == phone).first()
+        with self.session_scope(db) as db:
+            user = db.execute(
+                select(User.tier, User.expiry_date).where(User.phone == phone)
+            ).first()
             if not user:
                 raise Exception("User not found")
 
-            current_tier = user.tier
-            
             # If already on target tier or higher (assuming Advanced > Basic > Free)
             # We need a hierarchy. 
             # Free < Premium Basic < Premium Advanced
             
-            if current_tier == target_tier:
+            if user.tier == target_tier:
                 return {"amount": 0, "currency": "EUR", "description": "Already on this tier"}
             
-            if current_tier == SubscriptionTier.PREMIUM_ADVANCED and target_tier == SubscriptionTier.PREMIUM_BASIC:
-                return {"amount": 0, "currency": "EUR", "description": "Downgrade (no cost, scheduled)"}
-
-            # Basic -> Advanced
-            if current_tier == SubscriptionTier.PREMIUM_BASIC and target_tier == SubscriptionTier.PREMIUM_ADVANCED:
-                # Check if Yearly or Monthly
-                # We don't strictly track "Yearly" vs "Monthly" in the DB, just expiry.
-                # But we can infer or maybe we should have stored it. 
-                # For now, let's infer from remaining duration? 
-                # Or better, let's look at the requirement: "upgrade from basic to advanced per month should not be calculated by the number of day, it should just be set to 1 euro"
-                
-                now = datetime.utcnow()
-                if not user.expiry_date or user.expiry_date <= now:
-                    # Expired or Free -> Full price (handled by frontend usually, but here we can return full price)
-                    # But this method is specifically for "Upgrade", implying active sub.
-                    return {"amount": 3.00, "currency": "EUR", "description": "Full Price (Expired)"}
-
-                remaining = user.expiry_date - now
-                remaining_days = remaining.days
-                
-                # Heuristic: If remaining > 35 days, assume Yearly.
-                # User request: "payment for 5 months would be 5/12 * €10"
-                # So if they have ~5 months left, it's a yearly plan.
-                
-                # Round up to nearest month
-                import math
-                remaining_months = math.ceil(remaining_days / 30.0)
-                if remaining_months < 1: remaining_months = 1
-                
-                cost = remaining_months * 1.00 # 1 EUR per month difference
-                
-                return {
-                    "amount": cost, 
-                    "currency": "EUR", 
-                    "description": f"Upgrade to Advanced ({remaining_months} Months Upgraded)",
-                    "is_prorated": True,
-                    "upgrade_type": "monthly_prorated"
-                }
-
-            return {"amount": 0, "currency": "EUR", "description": "Unknown upgrade path"}
+            handler = _UPGRADE_TABLE.get((user.tier, target_tier))
+            if handler is None:
+                return {"amount": 0, "currency": "EUR", "description": "Unknown upgrade path"}
+            return handler(user)
             
-        finally:
-            db.close()
 
-    def schedule_downgrade(self, phone: str, target_tier: str):
+    def schedule_downgrade(self, phone: str, target_tier: str, db: Optional[Session] = None):
         """
         Schedule a downgrade to occur at the end of the current billing cycle.
         For Stripe, updates the subscription. For others, it's a no-op (user just buys Basic next time).
         """
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.phone == phone).first()
+        with self.session_scope(db) as db:
+            user = db.execute(
+                select(User.stripe_subscription_id).where(User.phone == phone)
+            ).first()
             if not user:
                 raise Exception("User not found")
                 
@@ -390,98 +591,116 @@ class UserManager:
             # The user just waits for expiry.
             return {"success": True, "message": "Plan will expire naturally. You can renew as Basic then."}
             
-        finally:
-            db.close()
 
 
     def generate_referral_code(self, length=8):
         """Generate a unique referral code."""
-        chars = string.ascii_uppercase + string.digits
-        return ''.join(random.choice(chars) for _ in range(length))
+        return ''.join(random.choices(_REFERRAL_CHARS, k=length))
 
-    def apply_referral_bonus(self, phone: str, referrer_code: str):
+    def apply_referral_bonus(self, phone: str, referrer_code: str, db: Optional[Session] = None):
         """Apply referral bonus to both users."""
         if not referrer_code:
             return
             
-        db = self.get_db()
-        try:
-            # Find new user
-            user = db.query(User).filter(User.phone == phone).first()
-            if not user:
-                return
-                
-            # Prevent self-referral
-            if user.referral_code == referrer_code:
-                return
-
-            # Find referrer
-            referrer = db.query(User).filter(User.referral_code == referrer_code).first()
-            if not referrer:
-                return
+        with self.session_scope(db) as db:
+            # Find new user and referrer in one query (only the columns the bonus needs).
+            # FOR UPDATE holds both rows until commit, so a concurrent call for the same
+            # user waits and then sees the bonus already applied.
+            rows = db.execute(
+                select(User.phone, User.referral_code, User.referred_by, User.tier, User.expiry_date)
+                .where(or_(User.phone == phone, User.referral_code == referrer_code))
+                .with_for_update()
+            ).all()
+            user = next((u for u in rows if u.phone == phone), None)
+            referrer = next((u for u in rows if u.referral_code == referrer_code), None)
             
             # Check if already referred
-            # Only return if they have been referred AND have received a benefit (e.g. not FREE anymore or has expiry)
+            # Only skip if they have been referred AND have received a benefit (e.g. not FREE anymore or has expiry)
             # This allows fixing users who got 'referred_by' set but didn't get the bonus due to bugs
-            if user.referred_by and user.tier != SubscriptionTier.FREE and user.expiry_date:
+            already_referred = (
+                user is not None and user.referred_by
+                and user.tier != SubscriptionTier.FREE and user.expiry_date
+            )
+            if already_referred:
                 logger.info(f"User {phone} already referred by {user.referred_by} and has active sub. Skipping.")
-                return
-                
-            # Link users (idempotent update)
-            user.referred_by = referrer.phone
             
-            # Only increment count if not already counted (approximate check)
-            # We don't have a separate table for referrals, so we can't be 100% sure if this specific referral was counted.
-            # But if we are here, we are likely applying the bonus for the first time.
-            referrer.referral_count += 1
+            # Missing user/referrer, self-referral or already referred: end the
+            # transaction now so the row locks aren't held for the rest of the request
+            if not user or not referrer or user.referral_code == referrer_code or already_referred:
+                db.commit()
+                return
             
             # Award bonus (7 days premium)
             bonus_days = 7
+            now = datetime.utcnow()
             
-            for u in [user, referrer]:
+            def bonus_values(u) -> dict:
                 # If free, upgrade to trial/premium
                 if u.tier == SubscriptionTier.FREE:
-                    u.tier = SubscriptionTier.PREMIUM_ADVANCED # Explicitly set to Advanced
-                    u.expiry_date = datetime.utcnow() + timedelta(days=bonus_days)
-                    u.trial_start_date = datetime.utcnow() # Mark trial as started
-                else:
-                    # Extend existing expiry
-                    if u.expiry_date:
-                        u.expiry_date += timedelta(days=bonus_days)
-                    else:
-                        u.expiry_date = datetime.utcnow() + timedelta(days=bonus_days)
-                    
-                    # Upgrade to Advanced if on Basic? 
-                    # User request: "referral upgrades both users for Premium Advanced"
-                    # So if they are on Basic, we should probably upgrade them too?
-                    # Let's assume yes for now to be generous and match "upgrades both users"
-                    if u.tier == SubscriptionTier.PREMIUM_BASIC:
-                        u.tier = SubscriptionTier.PREMIUM_ADVANCED
+                    return {
+                        "tier": SubscriptionTier.PREMIUM_ADVANCED, # Explicitly set to Advanced
+                        "expiry_date": now + timedelta(days=bonus_days),
+                        "trial_start_date": now # Mark trial as started
+                    }
+                # Extend existing expiry
+                values = {"expiry_date": (u.expiry_date or now) + timedelta(days=bonus_days)}
+                # Upgrade to Advanced if on Basic? 
+                # User request: "referral upgrades both users for Premium Advanced"
+                # So if they are on Basic, we should probably upgrade them too?
+                # Let's assume yes for now to be generous and match "upgrades both users"
+                if u.tier == SubscriptionTier.PREMIUM_BASIC:
+                    values["tier"] = SubscriptionTier.PREMIUM_ADVANCED
+                return values
+            
+            # Link users (idempotent update)
+            db.execute(
+                update(User).where(User.phone == user.phone)
+                .values(referred_by=referrer.phone, **bonus_values(user))
+            )
+            # Only increment count if not already counted (approximate check)
+            # We don't have a separate table for referrals, so we can't be 100% sure if this specific referral was counted.
+            # But if we are here, we are likely applying the bonus for the first time.
+            db.execute(
+                update(User).where(User.phone == referrer.phone)
+                .values(referral_count=func.coalesce(User.referral_count, 0) + 1, **bonus_values(referrer))
+            )
             
             db.commit()
+            self._invalidate_status(user.phone, referrer.phone)
+            RedisCache.delete(f"referral:{user.phone}", f"referral:{referrer.phone}")
             logger.info(f"Applied referral bonus: {referrer.phone} -> {user.phone}")
             
-        finally:
-            db.close()
 
-    def get_referral_info(self, phone: str):
+    async def aget_referral_info(self, phone: str):
+        """Async variant of get_referral_info; Redis and DB work run in a worker thread."""
+        return await asyncio.to_thread(self.get_referral_info, phone)
+
+    def get_referral_info(self, phone: str, db: Optional[Session] = None):
         """Get referral info for a user."""
-        db = self.get_db()
-        try:
-            user = db.query(User).filter(User.phone == phone).first()
+        key = f"referral:{phone}"
+        info = RedisCache.get(key)
+        if info is not None:
+            return info
+        
+        with self.session_scope(db) as db:
+            user = db.execute(
+                select(User.referral_code, User.referral_count, User.referred_by).where(User.phone == phone)
+            ).first()
             if not user:
                 return None
             
             # Ensure user has a code (migration support)
-            if not user.referral_code:
-                user.referral_code = self.generate_referral_code()
+            referral_code = user.referral_code
+            if not referral_code:
+                referral_code = self.generate_referral_code()
+                db.execute(update(User).where(User.phone == phone).values(referral_code=referral_code))
                 db.commit()
                 
-            return {
-                "referral_code": user.referral_code,
+            info = {
+                "referral_code": referral_code,
                 "referral_count": user.referral_count or 0,
                 "referred_by": user.referred_by
             }
-        finally:
-            db.close()
+            RedisCache.set(key, info, REDIS_CACHE_TTL)
+            return info
 